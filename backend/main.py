@@ -2,23 +2,35 @@ from __future__ import annotations
 
 import os
 import time
+import base64
 import json
 import re
 import logging
 import asyncio
+import functools
 import hmac
 import hashlib
 import secrets
 from urllib.parse import quote
-from contextlib import asynccontextmanager
-from typing import Dict, Set, Optional, List, Any, Tuple
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, Set, Optional, List, Any, Tuple, Callable, Iterable, Awaitable
+
+import orjson
 
 import psycopg
 from psycopg.rows import dict_row
+from psycopg.types.json import set_json_loads
+from psycopg_pool import ConnectionPool
+
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 
 import cloudinary
 import cloudinary.uploader
 
+import redis
+import redis.asyncio
+
 from fastapi import (
     FastAPI,
     WebSocket,
@@ -35,7 +47,8 @@ from fastapi import (
 )
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 
 
@@ -75,6 +88,11 @@ if not DATABASE_URL:
 # Normalize for psycopg
 if DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = "postgresql://" + DATABASE_URL[len("postgres://"):]
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", "5"))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", "20"))
+DB_POOL_TIMEOUT_SECONDS = float(os.environ.get("DB_POOL_TIMEOUT_SECONDS", "30"))
+# psycopg prepares a statement server-side once it has run this many times on a connection.
+DB_PREPARE_THRESHOLD = int(os.environ.get("DB_PREPARE_THRESHOLD", "1"))
 
 MAX_UPLOAD_MB = int(os.environ.get("MAX_UPLOAD_MB", "25"))
 MAX_UPLOAD_BYTES = MAX_UPLOAD_MB * 1024 * 1024
@@ -97,8 +115,24 @@ USERNAME_RE = re.compile(r"^[a-zA-Z0-9_]{3,20}$")
 RATE_LIMIT_WINDOW_SECONDS = int(os.environ.get("RATE_LIMIT_WINDOW_SECONDS", "60"))
 RATE_LIMIT_MAX_AUTH = int(os.environ.get("RATE_LIMIT_MAX_AUTH", "20"))
 RATE_LIMIT_MAX_SEND = int(os.environ.get("RATE_LIMIT_MAX_SEND", "100"))
+# Shared rate limiting and cross-worker WS fan-out; in-process only when unset.
+REDIS_URL = (os.environ.get("REDIS_URL") or "").strip()
+REDIS_POOL_SIZE = min(64, max(8, int(os.environ.get("REDIS_POOL_SIZE", "32"))))
+# Caps pool checkout, connect and each command; past it rate limiting falls back to local buckets.
+REDIS_TIMEOUT_SECONDS = float(os.environ.get("REDIS_TIMEOUT_SECONDS", "0.5"))
+DELIVERED_FLUSH_INTERVAL_SECONDS = float(os.environ.get("DELIVERED_FLUSH_INTERVAL_SECONDS", "0.25"))
+READS_FLUSH_INTERVAL_SECONDS = float(os.environ.get("READS_FLUSH_INTERVAL_SECONDS", "0.2"))
 WS_HEARTBEAT_INTERVAL_SECONDS = float(os.environ.get("WS_HEARTBEAT_INTERVAL_SECONDS", "20"))
 WS_HEARTBEAT_TIMEOUT_SECONDS = float(os.environ.get("WS_HEARTBEAT_TIMEOUT_SECONDS", "45"))
+WS_BATCH_WINDOW_SECONDS = float(os.environ.get("WS_BATCH_WINDOW_SECONDS", "0.02"))
+WS_BATCH_MAX_EVENTS = int(os.environ.get("WS_BATCH_MAX_EVENTS", "50"))
+
+# Argon2id: time_cost is calibrated at startup unless ARGON2_TIME_COST is set explicitly.
+PASSWORD_HASH_TARGET_MS = float(os.environ.get("PASSWORD_HASH_TARGET_MS", "250"))
+ARGON2_TIME_COST = int(os.environ.get("ARGON2_TIME_COST", "0"))
+ARGON2_MAX_TIME_COST = int(os.environ.get("ARGON2_MAX_TIME_COST", "10"))
+ARGON2_MEMORY_COST_KIB = int(os.environ.get("ARGON2_MEMORY_COST_KIB", str(19 * 1024)))
+ARGON2_PARALLELISM = int(os.environ.get("ARGON2_PARALLELISM", "1"))
 
 def parse_cors_origins(value: Optional[str]) -> List[str]:
     if value is None or not value.strip():
@@ -113,18 +147,6 @@ def parse_cors_origins(value: Optional[str]) -> List[str]:
 
 
 CORS_ORIGINS = parse_cors_origins(os.environ.get("CORS_ORIGINS"))
-cors_origins_env = os.environ.get("CORS_ORIGINS")
-if cors_origins_env is None or not cors_origins_env.strip():
-    cors_origins_env = "http://localhost"
-
-CORS_ORIGINS = [origin.strip() for origin in cors_origins_env.split(",") if origin.strip()]
-if not CORS_ORIGINS:
-    CORS_ORIGINS = ["http://localhost"]
-CORS_ORIGINS = [
-    origin.strip()
-    for origin in (os.environ.get("CORS_ORIGINS", "http://localhost") or "http://localhost").split(",")
-    if origin.strip()
-]
 
 # =========================
 # Cloudinary config
@@ -149,9 +171,44 @@ cloudinary.config(
 # =========================
 # DB helpers
 # =========================
+# jsonb columns (e.g. reactions in list_messages) are decoded with orjson, matching the response encoder.
+set_json_loads(orjson.loads)
+
+_POOL: Optional[ConnectionPool] = None
+
+
+def db_pool() -> ConnectionPool:
+    global _POOL
+    if _POOL is None:
+        _POOL = ConnectionPool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            timeout=DB_POOL_TIMEOUT_SECONDS,
+            kwargs={"row_factory": dict_row, "prepare_threshold": DB_PREPARE_THRESHOLD},
+            check=ConnectionPool.check_connection,
+            open=True,
+        )
+    return _POOL
+
+
 def db():
-    # new connection per action (simple + safe)
-    return psycopg.connect(DATABASE_URL, row_factory=dict_row)
+    # pooled connection; like psycopg.connect(), the context commits on success
+    # and rolls back on error, then hands the connection back to the pool
+    return db_pool().connection()
+
+
+@contextmanager
+def db_autocommit():
+    # for endpoints whose only write is a single statement: no BEGIN/COMMIT round-trips;
+    # the flag is reset before the connection goes back to the pool
+    with db() as conn:
+        conn.autocommit = True
+        try:
+            yield conn
+        finally:
+            if not conn.closed:
+                conn.autocommit = False
 
 
 def normalize_messages_limit(value: Optional[int]) -> int:
@@ -160,6 +217,20 @@ def normalize_messages_limit(value: Optional[int]) -> int:
     return max(1, min(int(value), 200))
 
 
+def encode_messages_cursor(message_id: int) -> str:
+    return b64url(orjson.dumps({"id": int(message_id)}))
+
+
+def decode_messages_cursor(cursor: str) -> int:
+    try:
+        message_id = int(orjson.loads(b64urldecode(cursor))["id"])
+    except (ValueError, TypeError, KeyError, orjson.JSONDecodeError):
+        raise HTTPException(status_code=400, detail="Bad cursor")
+    if message_id <= 0:
+        raise HTTPException(status_code=400, detail="Bad cursor")
+    return message_id
+
+
 def init_db() -> None:
     """
     Safe "migrations" via CREATE + ALTER ... IF NOT EXISTS.
@@ -367,9 +438,150 @@ def init_db() -> None:
             cur.execute("UPDATE messages SET edited_at = updated_at WHERE edited_at IS NULL AND updated_at IS NOT NULL;")
             cur.execute("UPDATE messages SET deleted_at = updated_at WHERE deleted_at IS NULL AND deleted_for_all = TRUE;")
             cur.execute("ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS role TEXT NOT NULL DEFAULT 'member';")
+            # Denormalized chat-list summary per member (see refresh_member_summaries).
+            cur.execute("ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS last_message_id BIGINT;")
+            cur.execute("ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS last_message_at BIGINT;")
+            cur.execute("ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS last_sender TEXT;")
+            cur.execute("ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS last_text_preview TEXT;")
+            cur.execute("ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS unread_count INT NOT NULL DEFAULT 0;")
             cur.execute(
                 "CREATE INDEX IF NOT EXISTS idx_messages_chat_created_id ON messages(chat_id, created_at, id);"
             )
+            # list_messages pages every message of a chat (deleted-for-all ones included) by id.
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages(chat_id, id DESC);")
+            # list_chats and membership hydration filter chat_members by username alone; the
+            # (chat_id, username) primary key only serves lookups that know the chat.
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_chat_members_username ON chat_members(username);")
+            # Latest-message LATERAL + unread counts in list_chats.
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_messages_chat_id_live ON messages(chat_id, id DESC) "
+                "WHERE deleted_for_all = FALSE;"
+            )
+            # Links tab in chat_overview: evaluate the link regex once at write time.
+            cur.execute(
+                """
+                ALTER TABLE messages ADD COLUMN IF NOT EXISTS has_link BOOLEAN
+                GENERATED ALWAYS AS (text ~* '(https?://[^\\s]+)' OR text LIKE 'www.%') STORED;
+                """
+            )
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_messages_chat_links ON messages(chat_id, id DESC) "
+                "WHERE has_link AND deleted_for_all = FALSE;"
+            )
+            # Media tab in chat_overview; INCLUDE makes it index-only.
+            cur.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_messages_chat_media ON messages(chat_id, id DESC)
+                INCLUDE (media_kind, media_url, media_name, sender, created_at)
+                WHERE media_url IS NOT NULL AND deleted_for_all = FALSE;
+                """
+            )
+            # Substring search in chat_overview (LOWER(text) LIKE '%q%'). pg_trgm may be unavailable
+            # without superuser rights; search then falls back to a scan.
+            cur.execute(
+                """
+                DO $$
+                BEGIN
+                    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+                EXCEPTION WHEN insufficient_privilege THEN
+                    RAISE NOTICE 'pg_trgm not available, skipping trigram index';
+                END $$;
+                """
+            )
+            cur.execute(
+                """
+                DO $$
+                BEGIN
+                    IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+                        CREATE INDEX IF NOT EXISTS idx_messages_text_trgm ON messages
+                        USING gin (LOWER(text) gin_trgm_ops) WHERE deleted_for_all = FALSE;
+                    END IF;
+                END $$;
+                """
+            )
+
+            # ON DELETE CASCADE foreign keys so deleting a chat (or message) cleans up dependents in-engine.
+            # Orphans are purged first, otherwise the constraint cannot be added to older DBs.
+            for table, column, ref_table, conname in (
+                ("messages", "chat_id", "chats", "fk_messages_chat"),
+                ("chat_members", "chat_id", "chats", "fk_chat_members_chat"),
+                ("chat_reads", "chat_id", "chats", "fk_chat_reads_chat"),
+                ("chat_pins", "chat_id", "chats", "fk_chat_pins_chat"),
+                ("chat_member_settings", "chat_id", "chats", "fk_chat_member_settings_chat"),
+                ("chat_pins", "message_id", "messages", "fk_chat_pins_message"),
+                ("message_hidden", "message_id", "messages", "fk_message_hidden_message"),
+                ("message_delivered", "message_id", "messages", "fk_message_delivered_message"),
+                ("message_reactions", "message_id", "messages", "fk_message_reactions_message"),
+            ):
+                cur.execute(
+                    f"""
+                    DO $$
+                    BEGIN
+                        IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = '{conname}') THEN
+                            DELETE FROM {table} t
+                            WHERE NOT EXISTS (SELECT 1 FROM {ref_table} p WHERE p.id = t.{column});
+                            ALTER TABLE {table}
+                                ADD CONSTRAINT {conname} FOREIGN KEY ({column})
+                                REFERENCES {ref_table}(id) ON DELETE CASCADE;
+                        END IF;
+                    END $$;
+                    """
+                )
+
+            # Receipt counter for message status: message_delivered rows from recipients (not the
+            # sender) are counted by trigger; existing receipts are counted once when the column appears.
+            cur.execute(
+                """
+                DO $$
+                BEGIN
+                    IF NOT EXISTS (
+                        SELECT 1 FROM information_schema.columns
+                        WHERE table_name = 'messages' AND column_name = 'delivered_count'
+                    ) THEN
+                        ALTER TABLE messages ADD COLUMN delivered_count INT NOT NULL DEFAULT 0;
+                        UPDATE messages m SET delivered_count = c.cnt
+                        FROM (
+                            SELECT d.message_id, COUNT(*) AS cnt
+                            FROM message_delivered d
+                            JOIN messages x ON x.id = d.message_id AND x.sender <> d.username
+                            GROUP BY d.message_id
+                        ) c
+                        WHERE m.id = c.message_id;
+                    END IF;
+                END $$;
+                """
+            )
+            cur.execute(
+                """
+                CREATE OR REPLACE FUNCTION bump_delivered_count() RETURNS trigger AS $$
+                BEGIN
+                    UPDATE messages SET delivered_count = delivered_count + 1
+                    WHERE id = NEW.message_id AND sender <> NEW.username;
+                    RETURN NULL;
+                END $$ LANGUAGE plpgsql;
+                """
+            )
+            # created once: no table lock on message_delivered at every worker start; a worker that
+            # loses the creation race to another one just moves on
+            cur.execute(
+                """
+                DO $$
+                BEGIN
+                    IF NOT EXISTS (
+                        SELECT 1 FROM pg_trigger
+                        WHERE tgname = 'message_delivered_count'
+                          AND tgrelid = 'message_delivered'::regclass
+                    ) THEN
+                        CREATE TRIGGER message_delivered_count AFTER INSERT ON message_delivered
+                        FOR EACH ROW EXECUTE FUNCTION bump_delivered_count();
+                    END IF;
+                EXCEPTION WHEN duplicate_object THEN
+                    NULL;
+                END $$;
+                """
+            )
+            # Read counter is an index range count: readers are members whose last_read_id >= message id.
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_chat_reads_chat_last_read ON chat_reads(chat_id, last_read_id);")
 
             # Remove legacy auto-created public room "general".
             cur.execute("DELETE FROM message_hidden WHERE message_id IN (SELECT id FROM messages WHERE chat_id='general')")
@@ -380,39 +592,133 @@ def init_db() -> None:
             cur.execute("DELETE FROM chats WHERE id='general'")
 
             # Ensure each user has a personal chat "Избранное".
-            cur.execute("SELECT username FROM users")
-            users = [r["username"] for r in cur.fetchall()]
+            # Set-based backfill for legacy users; new users get it in register().
             ts = int(time.time())
-            for uname in users:
-                fav_id = f"fav:{uname}"
-                cur.execute(
-                    """
-                    INSERT INTO chats(id, type, title, created_by, created_at)
-                    VALUES (%s,%s,%s,%s,%s)
-                    ON CONFLICT (id) DO NOTHING
-                    """,
-                    (fav_id, "dm", "Избранное", uname, ts),
-                )
-                cur.execute(
-                    """
-                    INSERT INTO chat_members(chat_id, username, role, joined_at)
-                    VALUES (%s,%s,%s,%s)
-                    ON CONFLICT (chat_id, username) DO NOTHING
-                    """,
-                    (fav_id, uname, "owner", ts),
-                )
-                cur.execute(
-                    """
-                    INSERT INTO chat_reads(chat_id, username, last_read_id, updated_at)
-                    VALUES (%s,%s,%s,%s)
-                    ON CONFLICT (chat_id, username) DO NOTHING
-                    """,
-                    (fav_id, uname, 0, ts),
-                )
+            cur.execute(
+                """
+                INSERT INTO chats(id, type, title, created_by, created_at)
+                SELECT 'fav:' || u.username, 'dm', 'Избранное', u.username, %s
+                FROM users u
+                ON CONFLICT (id) DO NOTHING
+                """,
+                (ts,),
+            )
+            cur.execute(
+                """
+                INSERT INTO chat_members(chat_id, username, role, joined_at)
+                SELECT 'fav:' || u.username, u.username, 'owner', %s
+                FROM users u
+                ON CONFLICT (chat_id, username) DO NOTHING
+                """,
+                (ts,),
+            )
+            cur.execute(
+                """
+                INSERT INTO chat_reads(chat_id, username, last_read_id, updated_at)
+                SELECT 'fav:' || u.username, u.username, 0, %s
+                FROM users u
+                ON CONFLICT (chat_id, username) DO NOTHING
+                """,
+                (ts,),
+            )
+
+            # Backfill summaries for rows created before the columns existed, then default new rows to 0.
+            refresh_member_summaries(cur, where="m.last_message_id IS NULL")
+            cur.execute("ALTER TABLE chat_members ALTER COLUMN last_message_id SET DEFAULT 0;")
 
         conn.commit()
 
 
+LAST_TEXT_PREVIEW_CHARS = 200
+
+_MEMBER_SUMMARY_SQL = """
+UPDATE chat_members cm
+SET last_message_id = COALESCE(s.last_message_id, 0),
+    last_message_at = s.last_message_at,
+    last_sender = s.last_sender,
+    last_text_preview = s.last_text_preview,
+    unread_count = s.unread_count
+FROM (
+    SELECT
+        m.chat_id, m.username,
+        lm.id AS last_message_id,
+        lm.created_at AS last_message_at,
+        lm.sender AS last_sender,
+        LEFT(lm.text, %s) AS last_text_preview,
+        un.n AS unread_count
+    FROM chat_members m
+    LEFT JOIN chat_reads r
+      ON r.chat_id = m.chat_id AND r.username = m.username
+    LEFT JOIN LATERAL (
+        SELECT msg.id, msg.created_at, msg.sender, msg.text
+        FROM messages msg
+        LEFT JOIN message_hidden h
+          ON h.message_id = msg.id AND h.username = m.username
+        WHERE msg.chat_id = m.chat_id
+          AND msg.deleted_for_all = FALSE
+          AND h.message_id IS NULL
+        ORDER BY msg.id DESC
+        LIMIT 1
+    ) lm ON TRUE
+    LEFT JOIN LATERAL (
+        SELECT COUNT(*) AS n
+        FROM messages msg
+        LEFT JOIN message_hidden h
+          ON h.message_id = msg.id AND h.username = m.username
+        WHERE msg.chat_id = m.chat_id
+          AND msg.sender <> m.username
+          AND msg.deleted_for_all = FALSE
+          AND h.message_id IS NULL
+          AND msg.id > COALESCE(r.last_read_id, 0)
+    ) un ON TRUE
+    WHERE {where}
+) s
+WHERE cm.chat_id = s.chat_id AND cm.username = s.username
+"""
+
+
+def refresh_member_summaries(
+    cur: Any,
+    chat_id: Optional[str] = None,
+    username: Optional[str] = None,
+    *,
+    where: str = "",
+) -> None:
+    """
+    Recompute last_message_* / unread_count on chat_members from messages.
+    Used where an incremental update is not enough (reads, deletes, joins).
+    """
+    params: List[Any] = [LAST_TEXT_PREVIEW_CHARS]
+    if not where:
+        where = "m.chat_id = %s"
+        params.append(chat_id)
+        if username is not None:
+            where += " AND m.username = %s"
+            params.append(username)
+    cur.execute(_MEMBER_SUMMARY_SQL.format(where=where), params)
+
+
+def bump_member_summaries(cur: Any, chat_id: str, message_id: int, created_at: int, sender: str, text: str) -> None:
+    # Incremental update on send: new last message for everyone, +1 unread for everyone but the sender.
+    # Concurrent sends can commit out of id order; last_* only ever moves forward.
+    cur.execute(
+        """
+        WITH v AS (SELECT %s::bigint AS id, %s::bigint AS at, %s::text AS sender, LEFT(%s, %s) AS preview)
+        UPDATE chat_members cm
+        SET last_message_id = CASE WHEN v.id > COALESCE(cm.last_message_id, 0) THEN v.id ELSE cm.last_message_id END,
+            last_message_at = CASE WHEN v.id > COALESCE(cm.last_message_id, 0) THEN v.at ELSE cm.last_message_at END,
+            last_sender = CASE WHEN v.id > COALESCE(cm.last_message_id, 0) THEN v.sender ELSE cm.last_sender END,
+            last_text_preview = CASE
+                WHEN v.id > COALESCE(cm.last_message_id, 0) THEN v.preview ELSE cm.last_text_preview
+            END,
+            unread_count = cm.unread_count + CASE WHEN cm.username <> v.sender THEN 1 ELSE 0 END
+        FROM v
+        WHERE cm.chat_id = %s
+        """,
+        (message_id, created_at, sender, text, LAST_TEXT_PREVIEW_CHARS, chat_id),
+    )
+
+
 def is_member(conn, chat_id: str, username: str) -> bool:
     with conn.cursor() as cur:
         cur.execute(
@@ -422,9 +728,43 @@ def is_member(conn, chat_id: str, username: str) -> bool:
         return cur.fetchone() is not None
 
 
+# WEB_CONCURRENCY is the worker count uvicorn/gunicorn read by default.
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY") or "1")
+# (chat_id, username) -> monotonic expiry. Only positive checks are cached, so new members are
+# seen at once. Removals evict locally and, only when REDIS_URL is set, on other workers via the
+# broadcast relay; without it another worker would keep serving a removed member for the whole
+# TTL, so several workers without Redis run with the cache off (TTL 0).
+MEMBER_CACHE_TTL_SECONDS = (
+    float(os.environ.get("MEMBER_CACHE_TTL_SECONDS", "30")) if REDIS_URL or WEB_CONCURRENCY <= 1 else 0.0
+)
+MEMBER_CACHE_MAX_ENTRIES = 100_000
+MEMBER_CACHE: Dict[Tuple[str, str], float] = {}
+
+
+def member_cache_hit(chat_id: str, username: str) -> bool:
+    expires_at = MEMBER_CACHE.get((chat_id, username))
+    return expires_at is not None and expires_at > time.monotonic()
+
+
 def require_member(conn, chat_id: str, username: str) -> None:
+    if member_cache_hit(chat_id, username):
+        return
+    key = (chat_id, username)
+    now = time.monotonic()
     if not is_member(conn, chat_id, username):
+        MEMBER_CACHE.pop(key, None)
         raise HTTPException(status_code=403, detail="Not a member")
+    if MEMBER_CACHE_TTL_SECONDS <= 0:
+        return
+    if len(MEMBER_CACHE) >= MEMBER_CACHE_MAX_ENTRIES:
+        MEMBER_CACHE.clear()
+    MEMBER_CACHE[key] = now + MEMBER_CACHE_TTL_SECONDS
+
+
+def require_member_pooled(chat_id: str, username: str) -> None:
+    # for threadpool callers without a connection at hand
+    with db() as conn:
+        require_member(conn, chat_id, username)
 
 
 def favorites_chat_id(username: str) -> str:
@@ -435,7 +775,8 @@ def ensure_favorites_for(username: str) -> None:
     chat_id = favorites_chat_id(username)
     ts = int(time.time())
     with db() as conn:
-        with conn.cursor() as cur:
+        # three independent upserts: one pipelined round-trip
+        with conn.cursor() as cur, conn.pipeline():
             cur.execute(
                 """
                 INSERT INTO chats(id, type, title, created_by, created_at)
@@ -472,27 +813,6 @@ def list_members(chat_id: str) -> List[str]:
             return [r["username"] for r in cur.fetchall()]
 
 
-def get_member_role(conn, chat_id: str, username: str) -> Optional[str]:
-    with conn.cursor() as cur:
-        cur.execute(
-            "SELECT role FROM chat_members WHERE chat_id=%s AND username=%s",
-            (chat_id, username),
-        )
-        row = cur.fetchone()
-        return (row["role"] if row else None)
-
-
-def can_moderate(conn, chat_id: str, username: str) -> bool:
-    chat = get_chat(conn, chat_id)
-    if not chat:
-        return False
-    if chat["type"] == "dm":
-        # In 1:1 chats both participants have equal admin privileges.
-        return is_member(conn, chat_id, username)
-    role = get_member_role(conn, chat_id, username)
-    return role in ("owner", "admin")
-
-
 def _insert_refresh_token(cur: Any, username: str, now: int, session_id: str) -> str:
     token = secrets.token_urlsafe(36)
     cur.execute(
@@ -544,6 +864,68 @@ class RateLimitExceeded(Exception):
         self.retry_after_seconds = retry_after_seconds
 
 
+# Sliding window in one round-trip: trim, count, admit. Returns {allowed, retry_after_ms}.
+_RATE_LIMIT_LUA = """
+local key = KEYS[1]
+local now_ms = tonumber(ARGV[1])
+local window_ms = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', key, 0, now_ms - window_ms)
+if redis.call('ZCARD', key) >= limit then
+  local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+  return {0, window_ms - (now_ms - tonumber(oldest[2]))}
+end
+redis.call('ZADD', key, now_ms, ARGV[4])
+redis.call('PEXPIRE', key, window_ms)
+return {1, 0}
+"""
+
+# Both pools block for at most REDIS_TIMEOUT_SECONDS, then raise ConnectionError (a RedisError).
+_REDIS_POOL_KWARGS = {
+    "max_connections": REDIS_POOL_SIZE,
+    "timeout": REDIS_TIMEOUT_SECONDS,
+    "socket_timeout": REDIS_TIMEOUT_SECONDS,
+    "socket_connect_timeout": REDIS_TIMEOUT_SECONDS,
+}
+
+# Sync client for the threadpool handlers (auth); the async handlers use _RATE_LIMIT_SCRIPT_ASYNC.
+_RATE_LIMIT_SCRIPT = None
+if REDIS_URL:
+    _REDIS = redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(REDIS_URL, **_REDIS_POOL_KWARGS))
+    # register_script runs via EVALSHA and reloads the script on NOSCRIPT.
+    _RATE_LIMIT_SCRIPT = _REDIS.register_script(_RATE_LIMIT_LUA)
+
+# redis.asyncio twin bound to the app loop; created in _lifespan when REDIS_URL is set.
+_RATE_LIMIT_REDIS: Optional[Any] = None
+_RATE_LIMIT_SCRIPT_ASYNC = None
+
+
+def _check_rate_limit_local(bucket: str, limit: int) -> int:
+    now = now_ts()
+    start = now - RATE_LIMIT_WINDOW_SECONDS
+    arr = [t for t in RATE_BUCKETS.get(bucket, []) if t >= start]
+    if len(arr) >= limit:
+        return max(1, RATE_LIMIT_WINDOW_SECONDS - (now - arr[0]))
+    arr.append(now)
+    RATE_BUCKETS[bucket] = arr
+    return 0
+
+
+def _rate_limit_script_call(bucket: str, limit: int) -> dict:
+    now_ms = int(time.time() * 1000)
+    return {
+        "keys": [f"rl:{bucket}"],
+        "args": [now_ms, RATE_LIMIT_WINDOW_SECONDS * 1000, limit, f"{now_ms}:{secrets.token_hex(4)}"],
+    }
+
+
+def _rate_limit_retry_after(result: List[Any]) -> int:
+    allowed, retry_ms = result
+    if int(allowed):
+        return 0
+    return max(1, -(-int(retry_ms) // 1000))
+
+
 def check_rate_limit(
     bucket: str,
     limit: int,
@@ -551,14 +933,38 @@ def check_rate_limit(
     error: str = "rate_limit_exceeded",
     message: str = "Too many requests. Try again later.",
 ) -> None:
-    now = now_ts()
-    start = now - RATE_LIMIT_WINDOW_SECONDS
-    arr = [t for t in RATE_BUCKETS.get(bucket, []) if t >= start]
-    if len(arr) >= limit:
-        retry_after = max(1, RATE_LIMIT_WINDOW_SECONDS - (now - arr[0]))
+    if _RATE_LIMIT_SCRIPT is not None:
+        try:
+            retry_after = _rate_limit_retry_after(_RATE_LIMIT_SCRIPT(**_rate_limit_script_call(bucket, limit)))
+        except redis.RedisError:
+            LOGGER.warning("redis rate limit unavailable, falling back to in-process buckets")
+            retry_after = _check_rate_limit_local(bucket, limit)
+    else:
+        retry_after = _check_rate_limit_local(bucket, limit)
+    if retry_after:
+        raise RateLimitExceeded(message=message, error=error, retry_after_seconds=retry_after)
+
+
+async def check_rate_limit_async(
+    bucket: str,
+    limit: int,
+    *,
+    error: str = "rate_limit_exceeded",
+    message: str = "Too many requests. Try again later.",
+) -> None:
+    # for async def handlers: a slow Redis must not stall the event loop
+    if _RATE_LIMIT_SCRIPT_ASYNC is not None:
+        try:
+            retry_after = _rate_limit_retry_after(
+                await _RATE_LIMIT_SCRIPT_ASYNC(**_rate_limit_script_call(bucket, limit))
+            )
+        except redis.RedisError:
+            LOGGER.warning("redis rate limit unavailable, falling back to in-process buckets")
+            retry_after = _check_rate_limit_local(bucket, limit)
+    else:
+        retry_after = _check_rate_limit_local(bucket, limit)
+    if retry_after:
         raise RateLimitExceeded(message=message, error=error, retry_after_seconds=retry_after)
-    arr.append(now)
-    RATE_BUCKETS[bucket] = arr
 
 
 def check_auth_rate_limit(request: Request, action: str) -> None:
@@ -577,67 +983,188 @@ def get_chat(conn, chat_id: str) -> Optional[dict]:
         return cur.fetchone()
 
 
+def load_chat_context(conn, chat_id: str, username: str) -> Optional[dict]:
+    # chat row plus the caller's role (None for non-members) in a single lookup
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT c.*, m.role
+            FROM chats c
+            LEFT JOIN chat_members m ON m.chat_id=c.id AND m.username=%s
+            WHERE c.id=%s
+            """,
+            (username, chat_id),
+        )
+        return cur.fetchone()
+
+
+def context_can_moderate(ctx: dict) -> bool:
+    # in 1:1 chats both participants have equal admin privileges
+    if ctx["role"] is None:
+        return False
+    return ctx["type"] == "dm" or ctx["role"] in ("owner", "admin")
+
+
 # =========================
-# Password hashing (PBKDF2)
+# Password hashing (Argon2id, legacy PBKDF2)
 # =========================
-def hash_password(password: str, salt: Optional[str] = None) -> str:
-    if salt is None:
-        salt = secrets.token_hex(16)
-    dk = hashlib.pbkdf2_hmac("sha256", password.encode(), salt.encode(), 200_000)
-    return f"pbkdf2_sha256$200000${salt}${dk.hex()}"
+_PASSWORD_HASHER: Optional[PasswordHasher] = None
+
+
+def calibrate_password_hasher(target_ms: float = PASSWORD_HASH_TARGET_MS) -> PasswordHasher:
+    # Raise time_cost until one hash takes ~target_ms on this box.
+    time_cost = 2
+    while True:
+        hasher = PasswordHasher(
+            time_cost=time_cost,
+            memory_cost=ARGON2_MEMORY_COST_KIB,
+            parallelism=ARGON2_PARALLELISM,
+        )
+        started = time.perf_counter()
+        hasher.hash("calibration")
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if elapsed_ms >= target_ms or time_cost >= ARGON2_MAX_TIME_COST:
+            LOGGER.info("argon2id calibrated time_cost=%s elapsed_ms=%.1f", time_cost, elapsed_ms)
+            return hasher
+        time_cost += 1
+
+
+def password_hasher() -> PasswordHasher:
+    global _PASSWORD_HASHER
+    if _PASSWORD_HASHER is None:
+        if ARGON2_TIME_COST > 0:
+            _PASSWORD_HASHER = PasswordHasher(
+                time_cost=ARGON2_TIME_COST,
+                memory_cost=ARGON2_MEMORY_COST_KIB,
+                parallelism=ARGON2_PARALLELISM,
+            )
+        else:
+            _PASSWORD_HASHER = calibrate_password_hasher()
+    return _PASSWORD_HASHER
+
+
+def _pbkdf2_hash(password: str, salt: str, iterations: int = 200_000) -> str:
+    dk = hashlib.pbkdf2_hmac("sha256", password.encode(), salt.encode(), iterations)
+    return f"pbkdf2_sha256${iterations}${salt}${dk.hex()}"
+
+
+def hash_password(password: str) -> str:
+    return password_hasher().hash(password)
 
 
 def verify_password(password: str, stored: str) -> bool:
+    if stored.startswith("$argon2"):
+        try:
+            return password_hasher().verify(stored, password)
+        except (VerificationError, InvalidHashError):
+            return False
+
+    # Legacy PBKDF2 hashes; upgraded to Argon2id on the next successful login.
     try:
-        _, _, salt, _ = stored.split("$", 3)
+        algo, iterations, salt, hex_digest = stored.split("$", 3)
+        iterations_n = int(iterations)
+        expected = bytes.fromhex(hex_digest)
     except ValueError:
         return False
-    return hmac.compare_digest(hash_password(password, salt), stored)
+    if algo != "pbkdf2_sha256":
+        return False
+    dk = hashlib.pbkdf2_hmac("sha256", password.encode(), salt.encode(), iterations_n)
+    return hmac.compare_digest(dk, expected)
+
+
+def password_needs_rehash(stored: str) -> bool:
+    if not stored.startswith("$argon2id$"):
+        return True
+    try:
+        return password_hasher().check_needs_rehash(stored)
+    except InvalidHashError:
+        return True
 
 
 # =========================
 # Minimal JWT HS256
 # =========================
 def b64url(data: bytes) -> str:
-    import base64
     return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
 
 
 def b64urldecode(data: str) -> bytes:
-    import base64
     pad = "=" * (-len(data) % 4)
-    return base64.urlsafe_b64decode((data + pad).encode("ascii"))
+    return base64.urlsafe_b64decode(data + pad)
+
+
+_JWT_HEADER_B64 = b64url(orjson.dumps({"alg": "HS256", "typ": "JWT"}))
+# Keyed HMAC-SHA256 state (ipad/opad already absorbed); copy() it instead of re-keying per token.
+_SECRET_HMAC = hmac.new(JWT_SECRET.encode("utf-8"), digestmod=hashlib.sha256)
+
+
+def secret_hmac(msg: bytes) -> Any:
+    h = _SECRET_HMAC.copy()
+    h.update(msg)
+    return h
+
+
+def _jwt_sign_payload(payload: bytes) -> str:
+    payload_b64 = b64url(payload)
+    msg = f"{_JWT_HEADER_B64}.{payload_b64}".encode("ascii")
+    sig = secret_hmac(msg).digest()
+    return f"{_JWT_HEADER_B64}.{payload_b64}.{b64url(sig)}"
 
 
 def jwt_sign(payload: dict) -> str:
-    header = {"alg": "HS256", "typ": "JWT"}
-    header_b64 = b64url(json.dumps(header, separators=(",", ":")).encode())
-    payload_b64 = b64url(json.dumps(payload, separators=(",", ":")).encode())
-    msg = f"{header_b64}.{payload_b64}".encode("ascii")
-    sig = hmac.new(JWT_SECRET.encode(), msg, hashlib.sha256).digest()
-    return f"{header_b64}.{payload_b64}.{b64url(sig)}"
+    return _jwt_sign_payload(orjson.dumps(payload))
+
+
+def issue_access_token(username: str, now: int) -> str:
+    # Hot path for register/login/refresh: fixed-shape payload, no dict + json.dumps.
+    return _jwt_sign_payload(
+        b'{"sub":%b,"iat":%d,"exp":%d}' % (orjson.dumps(username), now, now + JWT_TTL_SECONDS)
+    )
+
+
+JWT_CACHE_MAX_ENTRIES = 4096
+# token -> verified payload. Access tokens are stateless, so a verified token stays valid until
+# its own exp, which is re-checked on every hit.
+JWT_CACHE: Dict[str, dict] = {}
 
 
 def jwt_verify(token: str) -> dict:
+    payload = JWT_CACHE.get(token)
+    if payload is None:
+        payload = _jwt_verify_signed(token)
+        if len(JWT_CACHE) >= JWT_CACHE_MAX_ENTRIES:
+            JWT_CACHE.clear()
+        JWT_CACHE[token] = payload
+    if int(payload.get("exp", 0)) < int(time.time()):
+        JWT_CACHE.pop(token, None)
+        raise HTTPException(status_code=401, detail="Token expired")
+    return payload
+
+
+def _jwt_verify_signed(token: str) -> dict:
     try:
         header_b64, payload_b64, sig_b64 = token.split(".", 2)
     except ValueError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
     msg = f"{header_b64}.{payload_b64}".encode("ascii")
-    expected = hmac.new(JWT_SECRET.encode(), msg, hashlib.sha256).digest()
-    if not hmac.compare_digest(b64url(expected), sig_b64):
+    # compare the canonical encoding: urlsafe_b64decode skips non-alphabet characters and ignores
+    # trailing bits, so decoding sig_b64 would accept many spellings of one signature
+    expected = b64url(secret_hmac(msg).digest()).encode("ascii")
+    if not hmac.compare_digest(expected, sig_b64.encode("utf-8")):
         raise HTTPException(status_code=401, detail="Bad signature")
 
-    payload = json.loads(b64urldecode(payload_b64))
-    if int(payload.get("exp", 0)) < int(time.time()):
-        raise HTTPException(status_code=401, detail="Token expired")
-    return payload
+    return orjson.loads(b64urldecode(payload_b64))
 
 
 def _extract_bearer(authorization: Optional[str]) -> Optional[str]:
     if not authorization:
         return None
+    # fast path for what every client sends: exactly "Bearer " + one token without whitespace
+    if authorization.startswith("Bearer "):
+        token = authorization[7:]
+        if token.split() == [token]:
+            return token
     parts = authorization.split(" ", 1)
     if len(parts) != 2:
         return None
@@ -692,9 +1219,45 @@ def now_ts() -> int:
     return int(time.time())
 
 
+def upload_size(file: UploadFile) -> int:
+    # Measure the spooled upload without copying it into memory.
+    f = file.file
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(0)
+    return size
+
+
+def wants_ndjson(request: Request) -> bool:
+    return "application/x-ndjson" in (request.headers.get("accept") or "")
+
+
+def _ndjson_line(payload: dict) -> bytes:
+    return orjson.dumps(payload) + b"\n"
+
+
+def ndjson_upload_response(size: int, finish: Callable[[], dict]) -> StreamingResponse:
+    """
+    Progress stream for clients sending Accept: application/x-ndjson:
+      {"stage":"received","bytes":N} -> {"stage":"uploading"} -> final result
+    Errors after the stream started are reported as {"ok": false, "detail": ...}.
+    """
+    async def agen():
+        yield _ndjson_line({"stage": "received", "bytes": size})
+        yield _ndjson_line({"stage": "uploading"})
+        try:
+            result = await run_in_threadpool(finish)
+        except HTTPException as e:
+            yield _ndjson_line({"ok": False, "status": e.status_code, "detail": e.detail})
+            return
+        yield _ndjson_line(result)
+
+    return StreamingResponse(agen(), media_type="application/x-ndjson")
+
+
 def _sign_media_token_payload(payload: dict) -> str:
-    body = json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
-    sig = hmac.new(JWT_SECRET.encode("utf-8"), body.encode("utf-8"), hashlib.sha256).hexdigest()
+    body = orjson.dumps(payload).decode("utf-8")
+    sig = secret_hmac(body.encode("utf-8")).hexdigest()
     return f"{body}.{sig}"
 
 
@@ -703,10 +1266,13 @@ def _verify_media_token(token: str) -> dict:
     if not token or "." not in token:
         raise HTTPException(status_code=403, detail="Invalid media token")
     body, sig = token.rsplit(".", 1)
-    expected = hmac.new(JWT_SECRET.encode("utf-8"), body.encode("utf-8"), hashlib.sha256).hexdigest()
+    expected = secret_hmac(body.encode("utf-8")).hexdigest()
     if not hmac.compare_digest(expected, sig):
         raise HTTPException(status_code=403, detail="Invalid media token")
-    payload = json.loads(body)
+    try:
+        payload = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=403, detail="Invalid media token")
     exp = int(payload.get("exp") or 0)
     if exp <= now_ts():
         raise HTTPException(status_code=403, detail="Media link expired")
@@ -759,23 +1325,87 @@ def get_build_meta() -> Dict[str, str]:
 # =========================
 # Realtime (Global WS per user)
 # =========================
-USER_SOCKETS: Dict[str, Set[WebSocket]] = {}
+# username -> immutable snapshot of that user's sockets; rebuilt on connect/disconnect so the
+# fan-out paths iterate it directly without copying per event.
+USER_SOCKETS: Dict[str, Tuple[WebSocket, ...]] = {}
+
+
+# socket -> monotonic time of its last pong; swept by the shared heartbeat_loop()
+WS_LAST_PONG: Dict[WebSocket, float] = {}
 
 
 def _ws_add(username: str, ws: WebSocket) -> None:
-    USER_SOCKETS.setdefault(username, set()).add(ws)
+    current = USER_SOCKETS.get(username, ())
+    if ws not in current:
+        USER_SOCKETS[username] = current + (ws,)
+    WS_LAST_PONG[ws] = time.monotonic()
 
 
 def _ws_remove(username: str, ws: WebSocket) -> None:
+    WS_LAST_PONG.pop(ws, None)
+    WS_OUTBOX.pop(ws, None)
     if username in USER_SOCKETS:
-        USER_SOCKETS[username].discard(ws)
-        if not USER_SOCKETS[username]:
+        remaining = tuple(s for s in USER_SOCKETS[username] if s is not ws)
+        if remaining:
+            USER_SOCKETS[username] = remaining
+        else:
             USER_SOCKETS.pop(username, None)
+            MEMBERSHIP.pop(username, None)
+
+
+# username -> chat_ids, kept only for users with an open socket so that the chatty
+# WS paths (typing, delivered, call signalling) skip the chat_members round-trip.
+# A miss always falls back to the DB: another worker may have added the membership.
+MEMBERSHIP: Dict[str, Set[str]] = {}
+
+
+def hydrate_membership(username: str) -> None:
+    if username in MEMBERSHIP:
+        return
+    with db() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT chat_id FROM chat_members WHERE username=%s", (username,))
+            MEMBERSHIP[username] = {r["chat_id"] for r in cur.fetchall()}
+
+
+def membership_add(chat_id: str, usernames: Iterable[str]) -> None:
+    for u in usernames:
+        chats = MEMBERSHIP.get(u)
+        if chats is not None:
+            chats.add(chat_id)
+
+
+def membership_discard(chat_id: str, usernames: Iterable[str]) -> None:
+    for u in usernames:
+        MEMBER_CACHE.pop((chat_id, u), None)
+        chats = MEMBERSHIP.get(u)
+        if chats is not None:
+            chats.discard(chat_id)
+
+
+def is_member_cached(chat_id: str, username: str) -> bool:
+    chats = MEMBERSHIP.get(username)
+    if chats is not None and chat_id in chats:
+        return True
+    with db() as conn:
+        ok = is_member(conn, chat_id, username)
+    if ok and chats is not None:
+        chats.add(chat_id)
+    return ok
+
+
+def ws_encode(payload: dict) -> str:
+    try:
+        return orjson.dumps(payload).decode("utf-8")
+    except TypeError:
+        # types orjson refuses (e.g. int subclasses, non-str keys)
+        return json.dumps(payload)
 
 
 async def ws_send_safe(ws: WebSocket, payload: dict) -> None:
     try:
-        await ws.send_text(json.dumps(payload))
+        # Text frames: the browser client JSON.parse()s ev.data directly.
+        await ws.send_text(ws_encode(payload))
     except Exception:
         # will be cleaned on next disconnect
         pass
@@ -819,24 +1449,347 @@ def get_user_messages_since(username: str, since_message_id: int, limit: int = 1
     return rows
 
 
+# =========================
+# list_chats cache (per process)
+# =========================
+# username -> (version, cached_at, rows); an entry is valid while its version matches CHATS_VERSION.
+# Mutators bump versions locally and, only when REDIS_URL is set, on other workers via the relay;
+# some (DM creation, mute, delete-for-me) only ever invalidate locally. As with MEMBER_CACHE,
+# several workers without Redis run with the cache off (TTL 0) rather than serve a stale list.
+CHATS_CACHE_TTL_SECONDS = (
+    float(os.environ.get("CHATS_CACHE_TTL_SECONDS", "30")) if REDIS_URL or WEB_CONCURRENCY <= 1 else 0.0
+)
+CHATS_CACHE: Dict[str, Tuple[int, float, List[dict]]] = {}
+CHATS_VERSION: Dict[str, int] = {}
+# Broadcast events that change what /api/chats returns for the recipients.
+CHAT_LIST_EVENTS = {
+    "message",
+    "message_edited",
+    "message_deleted_all",
+    "chat_deleted",
+    "member_removed",
+    "invited",
+    "pin_added",
+    "role_updated",
+    "read",
+}
+
+
+def invalidate_chats_cache(usernames: List[str]) -> None:
+    for u in usernames:
+        CHATS_VERSION[u] = CHATS_VERSION.get(u, 0) + 1
+
+
+# =========================
+# Sender avatar cache (per process)
+# =========================
+AVATAR_CACHE_TTL_SECONDS = float(os.environ.get("AVATAR_CACHE_TTL_SECONDS", "60"))
+# username -> (cached_at, avatar_url); the TTL bounds staleness for changes made on other workers.
+AVATAR_CACHE: Dict[str, Tuple[float, Optional[str]]] = {}
+
+
+def get_avatar_url(cur: Any, username: str) -> Optional[str]:
+    now = time.monotonic()
+    hit = AVATAR_CACHE.get(username)
+    if hit is not None and now - hit[0] < AVATAR_CACHE_TTL_SECONDS:
+        return hit[1]
+    cur.execute("SELECT avatar_url FROM users WHERE username=%s", (username,))
+    row = cur.fetchone()
+    url = row["avatar_url"] if row else None
+    AVATAR_CACHE[username] = (now, url)
+    return url
+
+
+# =========================
+# Media URL cache (per process)
+# =========================
+# message_id -> (monotonic expiry, chat_id, media_url) for live media messages. Delete-for-all and
+# chat deletion evict through _deliver_local: locally and, only when REDIS_URL is set, on other
+# workers via the broadcast relay. Like MEMBER_CACHE, several workers without Redis run with the
+# cache off (TTL 0) so deleted media cannot be opened through another worker's cache.
+MEDIA_CACHE_TTL_SECONDS = (
+    float(os.environ.get("MEDIA_CACHE_TTL_SECONDS", "30")) if REDIS_URL or WEB_CONCURRENCY <= 1 else 0.0
+)
+MEDIA_CACHE_MAX_ENTRIES = 50_000
+MEDIA_CACHE: Dict[int, Tuple[float, str, str]] = {}
+
+
+def media_cache_get(message_id: int) -> Optional[Tuple[str, str]]:
+    hit = MEDIA_CACHE.get(message_id)
+    if hit is None:
+        return None
+    if hit[0] <= time.monotonic():
+        MEDIA_CACHE.pop(message_id, None)
+        return None
+    return hit[1], hit[2]
+
+
+def media_cache_put(message_id: int, chat_id: str, media_url: str) -> None:
+    if MEDIA_CACHE_TTL_SECONDS <= 0:
+        return
+    if len(MEDIA_CACHE) >= MEDIA_CACHE_MAX_ENTRIES:
+        MEDIA_CACHE.clear()
+    MEDIA_CACHE[message_id] = (time.monotonic() + MEDIA_CACHE_TTL_SECONDS, chat_id, media_url)
+
+
+def media_cache_discard(payload: dict) -> None:
+    kind = payload.get("type")
+    if kind == "message_deleted_all":
+        MEDIA_CACHE.pop(int(payload.get("id") or 0), None)
+    elif kind == "chat_deleted":
+        chat_id = payload.get("chat_id")
+        for message_id in [k for k, v in MEDIA_CACHE.items() if v[1] == chat_id]:
+            MEDIA_CACHE.pop(message_id, None)
+
+
+# =========================
+# Broadcast (local sockets + Redis pub/sub relay between workers)
+# =========================
+BROADCAST_CHANNEL = "messenger:broadcast"
+WORKER_ID = secrets.token_hex(8)
+# redis.asyncio client bound to the app loop; created in _lifespan when REDIS_URL is set.
+_BROADCAST_REDIS: Optional[Any] = None
+
+
+# Sockets opened with ?batch=1 -> events waiting for the next flush. Broadcasts to such a socket
+# are coalesced for WS_BATCH_WINDOW_SECONDS into one {"type": "batch", "events": [...]} frame.
+WS_OUTBOX: Dict[WebSocket, List[dict]] = {}
+_WS_FLUSH_TASKS: Set[asyncio.Task] = set()
+
+
+async def _flush_outbox(ws: WebSocket) -> None:
+    events = WS_OUTBOX.get(ws)
+    if not events:
+        return
+    WS_OUTBOX[ws] = []
+    await ws_send_safe(ws, events[0] if len(events) == 1 else {"type": "batch", "events": events})
+
+
+async def _flush_outbox_later(ws: WebSocket) -> None:
+    await asyncio.sleep(WS_BATCH_WINDOW_SECONDS)
+    await _flush_outbox(ws)
+
+
+async def ws_send_event(ws: WebSocket, payload: dict) -> None:
+    outbox = WS_OUTBOX.get(ws)
+    if outbox is None:
+        await ws_send_safe(ws, payload)
+        return
+    outbox.append(payload)
+    if len(outbox) >= WS_BATCH_MAX_EVENTS:
+        await _flush_outbox(ws)
+    elif len(outbox) == 1:
+        task = asyncio.create_task(_flush_outbox_later(ws))
+        _WS_FLUSH_TASKS.add(task)
+        task.add_done_callback(_WS_FLUSH_TASKS.discard)
+
+
+async def _deliver_local(usernames: Iterable[str], payload: dict) -> None:
+    targets = set(usernames)
+    if payload.get("type") in CHAT_LIST_EVENTS:
+        invalidate_chats_cache(targets)
+    if payload.get("type") in ("member_removed", "chat_deleted"):
+        # also reached through the Redis relay, so other workers drop cached memberships too
+        membership_discard(payload.get("chat_id") or "", targets | {payload.get("username") or ""})
+    if MEDIA_CACHE and payload.get("type") in ("message_deleted_all", "chat_deleted"):
+        media_cache_discard(payload)
+    # Send to every socket concurrently: latency is max() of the sends, not sum().
+    await asyncio.gather(
+        *(ws_send_event(ws, payload) for u in targets for ws in USER_SOCKETS.get(u, ()))
+    )
+
+
 async def broadcast_users(usernames: List[str], payload: dict) -> None:
     if not usernames:
         return
-    sent_to = set()
-    for u in usernames:
-        if u in sent_to:
-            continue
-        sent_to.add(u)
-        for ws in list(USER_SOCKETS.get(u, set())):
-            await ws_send_safe(ws, payload)
+    await _deliver_local(usernames, payload)
+    if _BROADCAST_REDIS is None:
+        return
+    envelope = {"origin": WORKER_ID, "users": sorted(set(usernames)), "payload": payload}
+    try:
+        await _BROADCAST_REDIS.publish(BROADCAST_CHANNEL, ws_encode(envelope))
+    except redis.RedisError:
+        LOGGER.warning("redis broadcast publish failed; delivered to local sockets only")
+
+
+async def broadcast_relay_loop(client: Any) -> None:
+    # Relays broadcasts published by other workers to sockets held by this one.
+    while True:
+        try:
+            async with client.pubsub() as pubsub:
+                await pubsub.subscribe(BROADCAST_CHANNEL)
+                async for msg in pubsub.listen():
+                    if msg.get("type") != "message":
+                        continue
+                    try:
+                        envelope = orjson.loads(msg["data"])
+                    except orjson.JSONDecodeError:
+                        continue
+                    if envelope.get("origin") == WORKER_ID:
+                        continue
+                    await _deliver_local(envelope.get("users") or [], envelope.get("payload") or {})
+        except asyncio.CancelledError:
+            raise
+        except redis.RedisError:
+            LOGGER.warning("redis broadcast relay disconnected; retrying")
+            await asyncio.sleep(1)
 
 
 async def broadcast_chat(chat_id: str, payload: dict) -> None:
     await broadcast_users(list_members(chat_id), payload)
 
 
+# =========================
+# Delivered receipts (batched)
+# =========================
+# (chat_id, message_id, username) -> delivered_at; repeated receipts collapse before the flush.
+DELIVERED_PENDING: Dict[Tuple[str, int, str], int] = {}
+PG_BIGINT_MAX = 2**63 - 1
+
+
+def queue_delivered(chat_id: str, message_id: int, username: str) -> None:
+    DELIVERED_PENDING.setdefault((chat_id, message_id, username), now_ts())
+
+
+def flush_delivered() -> int:
+    global DELIVERED_PENDING
+    if not DELIVERED_PENDING:
+        return 0
+    pending, DELIVERED_PENDING = DELIVERED_PENDING, {}
+    keys = list(pending)
+    with db() as conn:
+        with conn.cursor() as cur:
+            # the join drops ids that are unknown or belong to another chat, so one bad receipt
+            # cannot fail the FK on message_delivered for the whole batch
+            cur.execute(
+                """
+                INSERT INTO message_delivered(message_id, username, delivered_at)
+                SELECT t.message_id, t.username, t.delivered_at
+                FROM unnest(%s::text[], %s::bigint[], %s::text[], %s::bigint[])
+                     AS t(chat_id, message_id, username, delivered_at)
+                JOIN messages m ON m.id = t.message_id AND m.chat_id = t.chat_id
+                ON CONFLICT (message_id, username) DO NOTHING
+                """,
+                ([k[0] for k in keys], [k[1] for k in keys], [k[2] for k in keys], [pending[k] for k in keys]),
+            )
+        conn.commit()
+    return len(keys)
+
+
+async def delivered_flush_loop() -> None:
+    while True:
+        await asyncio.sleep(DELIVERED_FLUSH_INTERVAL_SECONDS)
+        try:
+            await run_in_threadpool(flush_delivered)
+        except psycopg.Error:
+            # receipts are best-effort; a failed batch is dropped rather than retried forever
+            LOGGER.exception("delivered receipts flush failed")
+
+
+# =========================
+# Heartbeat (one timer for every socket of the process)
+# =========================
+async def _close_stale(ws: WebSocket) -> None:
+    WS_LAST_PONG.pop(ws, None)
+    try:
+        await ws.close(code=1011, reason="heartbeat timeout")
+    except Exception:
+        pass
+
+
+async def heartbeat_tick() -> None:
+    cutoff = time.monotonic() - WS_HEARTBEAT_TIMEOUT_SECONDS
+    ping = {"type": "ping", "ts": now_ts()}
+    await asyncio.gather(
+        *(_close_stale(ws) if last < cutoff else ws_send_safe(ws, ping) for ws, last in list(WS_LAST_PONG.items()))
+    )
+
+
+async def heartbeat_loop() -> None:
+    while True:
+        await asyncio.sleep(WS_HEARTBEAT_INTERVAL_SECONDS)
+        await heartbeat_tick()
+
+
+# =========================
+# Read markers over WS (batched)
+# =========================
+# (chat_id, username) -> highest last_read_id seen since the previous flush.
+PENDING_READS: Dict[Tuple[str, str], int] = {}
+
+
+def queue_read(chat_id: str, username: str, last_id: int) -> None:
+    key = (chat_id, username)
+    if last_id > PENDING_READS.get(key, 0):
+        PENDING_READS[key] = last_id
+
+
+def flush_reads() -> Tuple[List[Tuple[str, str, int]], Dict[str, List[str]]]:
+    # returns the flushed markers plus the members of their chats (the "read" event recipients)
+    global PENDING_READS
+    if not PENDING_READS:
+        return [], {}
+    pending, PENDING_READS = PENDING_READS, {}
+    items = [(chat_id, username, last_id) for (chat_id, username), last_id in pending.items()]
+    try:
+        members = _write_reads(items)
+    except Exception:
+        # unlike delivered receipts, read markers are not resent by the client: requeue for the next tick
+        for (chat_id, username), last_id in pending.items():
+            queue_read(chat_id, username, last_id)
+        raise
+    return items, members
+
+
+def _write_reads(items: List[Tuple[str, str, int]]) -> Dict[str, List[str]]:
+    with db() as conn:
+        with conn.cursor() as cur, conn.pipeline():
+            # same GREATEST upsert as POST /read; the join skips users who left meanwhile
+            cur.execute(
+                """
+                INSERT INTO chat_reads(chat_id, username, last_read_id, updated_at)
+                SELECT t.chat_id, t.username, t.last_id, %s
+                FROM unnest(%s::text[], %s::text[], %s::bigint[]) AS t(chat_id, username, last_id)
+                JOIN chat_members m ON m.chat_id = t.chat_id AND m.username = t.username
+                ON CONFLICT (chat_id, username)
+                DO UPDATE SET last_read_id = GREATEST(chat_reads.last_read_id, EXCLUDED.last_read_id),
+                              updated_at = EXCLUDED.updated_at
+                """,
+                (now_ts(), [i[0] for i in items], [i[1] for i in items], [i[2] for i in items]),
+            )
+            for chat_id, username, _ in items:
+                refresh_member_summaries(cur, chat_id, username)
+            # members of every chat in the batch in one query, so the loop does no per-chat lookups
+            cur.execute(
+                "SELECT chat_id, username FROM chat_members WHERE chat_id = ANY(%s)",
+                (list({i[0] for i in items}),),
+            )
+            members: Dict[str, List[str]] = {}
+            for r in cur.fetchall():
+                members.setdefault(r["chat_id"], []).append(r["username"])
+        conn.commit()
+    return members
+
+
+async def reads_flush_loop() -> None:
+    while True:
+        await asyncio.sleep(READS_FLUSH_INTERVAL_SECONDS)
+        try:
+            items, members = await run_in_threadpool(flush_reads)
+        except psycopg.Error:
+            LOGGER.exception("read markers flush failed")
+            continue
+        for chat_id, username, last_id in items:
+            await broadcast_users(members.get(chat_id, []), {
+                "type": "read",
+                "chat_id": chat_id,
+                "username": username,
+                "last_read_id": last_id,
+            })
+
+
 def active_connections_count(username: str) -> int:
-    return len(USER_SOCKETS.get(username, set()))
+    return len(USER_SOCKETS.get(username, ()))
 
 
 def connected_members(usernames: List[str]) -> List[str]:
@@ -848,11 +1801,47 @@ def connected_members(usernames: List[str]) -> List[str]:
 # =========================
 @asynccontextmanager
 async def _lifespan(app: FastAPI):
+    global _BROADCAST_REDIS, _RATE_LIMIT_REDIS, _RATE_LIMIT_SCRIPT_ASYNC, _POOL
+    db_pool()
     init_db()
-    yield
+    password_hasher()
+    tasks = [
+        asyncio.create_task(delivered_flush_loop()),
+        asyncio.create_task(reads_flush_loop()),
+        asyncio.create_task(heartbeat_loop()),
+    ]
+    if REDIS_URL:
+        _BROADCAST_REDIS = redis.asyncio.from_url(REDIS_URL)
+        tasks.append(asyncio.create_task(broadcast_relay_loop(_BROADCAST_REDIS)))
+        # separate from the pub/sub client: its socket timeout would cut the relay's blocking read
+        _RATE_LIMIT_REDIS = redis.asyncio.Redis(
+            connection_pool=redis.asyncio.BlockingConnectionPool.from_url(REDIS_URL, **_REDIS_POOL_KWARGS)
+        )
+        _RATE_LIMIT_SCRIPT_ASYNC = _RATE_LIMIT_REDIS.register_script(_RATE_LIMIT_LUA)
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if _BROADCAST_REDIS is not None:
+            await _BROADCAST_REDIS.aclose()
+            _BROADCAST_REDIS = None
+        if _RATE_LIMIT_REDIS is not None:
+            _RATE_LIMIT_SCRIPT_ASYNC = None
+            await _RATE_LIMIT_REDIS.aclose()
+            _RATE_LIMIT_REDIS = None
+        try:
+            flush_delivered()
+            flush_reads()
+        except psycopg.Error:
+            LOGGER.exception("receipts flush failed on shutdown")
+        if _POOL is not None:
+            _POOL.close()
+            _POOL = None
 
 
-app = FastAPI(lifespan=_lifespan)
+app = FastAPI(lifespan=_lifespan, default_response_class=ORJSONResponse)
 
 
 @app.exception_handler(RateLimitExceeded)
@@ -888,16 +1877,15 @@ async def request_logging_middleware(request: Request, call_next):
     finally:
         latency_ms = round((time.perf_counter() - started) * 1000, 2)
         LOGGER.info(
-            json.dumps(
+            orjson.dumps(
                 {
                     "method": request.method,
                     "path": request.url.path,
                     "status": status_code,
                     "latency_ms": latency_ms,
                     "user_id": user_id,
-                },
-                ensure_ascii=False,
-            )
+                }
+            ).decode("utf-8")
         )
 
 
@@ -1015,13 +2003,16 @@ def register(data: AuthIn, request: Request, response: Response):
     if len(password) < 6:
         raise HTTPException(status_code=400, detail="Password: минимум 6 символов.")
 
+    # hash before checking out a pooled connection: the KDF must not hold one for its whole run
+    # (calibrated at startup to PASSWORD_HASH_TARGET_MS)
+    pass_hash = hash_password(password)
     now = now_ts()
     try:
         with db() as conn:
             with conn.cursor() as cur:
                 cur.execute(
                     "INSERT INTO users(username, pass_hash, created_at) VALUES(%s,%s,%s)",
-                    (username, hash_password(password), now),
+                    (username, pass_hash, now),
                 )
             conn.commit()
     except psycopg.errors.UniqueViolation:
@@ -1029,7 +2020,7 @@ def register(data: AuthIn, request: Request, response: Response):
 
     ensure_favorites_for(username)
 
-    token = jwt_sign({"sub": username, "iat": now, "exp": now + JWT_TTL_SECONDS})
+    token = issue_access_token(username, now)
     refresh_token = issue_refresh_token(username)
     set_refresh_cookie(response, refresh_token)
     return {"token": token, "username": username}
@@ -1048,10 +2039,18 @@ def login(data: AuthIn, request: Request, response: Response):
     if not row or not verify_password(data.password, row["pass_hash"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
-    ensure_favorites_for(username)
+    if password_needs_rehash(row["pass_hash"]):
+        pass_hash = hash_password(data.password)
+        with db() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE users SET pass_hash=%s WHERE username=%s",
+                    (pass_hash, username),
+                )
+            conn.commit()
 
     now = now_ts()
-    token = jwt_sign({"sub": username, "iat": now, "exp": now + JWT_TTL_SECONDS})
+    token = issue_access_token(username, now)
     refresh_token = issue_refresh_token(username)
     set_refresh_cookie(response, refresh_token)
     return {"token": token, "username": username}
@@ -1066,6 +2065,7 @@ def refresh_tokens(request: Request, response: Response):
     if not rt:
         raise HTTPException(status_code=400, detail="refresh_token required")
 
+    now = now_ts()
     with db() as conn:
         with conn.cursor() as cur:
             cur.execute(
@@ -1073,7 +2073,7 @@ def refresh_tokens(request: Request, response: Response):
                 (rt,),
             )
             row = cur.fetchone()
-            if not row or int(row["expires_at"]) < now_ts():
+            if not row or int(row["expires_at"]) < now:
                 raise HTTPException(status_code=401, detail="Invalid refresh token")
 
             if row["revoked"]:
@@ -1090,12 +2090,11 @@ def refresh_tokens(request: Request, response: Response):
 
             username = row["username"]
             session_id = row["session_id"]
-            new_rt = _insert_refresh_token(cur, username, now_ts(), session_id)
+            new_rt = _insert_refresh_token(cur, username, now, session_id)
             cur.execute("UPDATE refresh_tokens SET revoked=TRUE, replaced_by=%s WHERE token=%s", (new_rt, rt))
         conn.commit()
 
-    now = now_ts()
-    token = jwt_sign({"sub": username, "iat": now, "exp": now + JWT_TTL_SECONDS})
+    token = issue_access_token(username, now)
     set_refresh_cookie(response, new_rt)
     return {"token": token, "username": username}
 
@@ -1160,11 +2159,12 @@ def list_stories(username: str = Depends(get_current_username)):
             )
             rows = cur.fetchall()
         conn.commit()
-    return {"stories": rows}
+    return ORJSONResponse(content={"stories": rows})
 
 
 @app.post("/api/stories")
 async def create_story(
+    request: Request,
     file: UploadFile = File(...),
     caption: str = Form(""),
     username: str = Depends(get_current_username),
@@ -1173,36 +2173,43 @@ async def create_story(
     kind = "image" if content_type.startswith("image/") else ("video" if content_type.startswith("video/") else "")
     if not kind:
         raise HTTPException(status_code=400, detail="Story supports image/video only")
+    caption = (caption or "").strip()[:160]
 
-    data = await file.read()
-    if len(data) > MAX_UPLOAD_BYTES:
+    size = upload_size(file)
+    if size > MAX_UPLOAD_BYTES:
         raise HTTPException(status_code=413, detail=f"File too large (max {MAX_UPLOAD_MB}MB)")
 
-    resource_type = "image" if kind == "image" else "video"
-    try:
-        up = cloudinary.uploader.upload(
-            data,
-            folder="messenger/stories",
-            resource_type=resource_type,
-        )
-        url = up.get("secure_url") or up.get("url")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Cloudinary upload failed: {e}")
-
-    now = now_ts()
-    with db() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO stories(username, media_url, media_kind, caption, created_at, expires_at)
-                VALUES (%s,%s,%s,%s,%s,%s)
-                RETURNING id
-                """,
-                (username, url, kind, (caption or "").strip()[:160], now, now + 24 * 60 * 60),
+    def finish() -> dict:
+        resource_type = "image" if kind == "image" else "video"
+        try:
+            up = cloudinary.uploader.upload(
+                file.file,
+                folder="messenger/stories",
+                resource_type=resource_type,
             )
-            story_id = int(cur.fetchone()["id"])
-        conn.commit()
-    return {"ok": True, "id": story_id, "media_url": url}
+            url = up.get("secure_url") or up.get("url")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Cloudinary upload failed: {e}")
+
+        now = now_ts()
+        with db() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    INSERT INTO stories(username, media_url, media_kind, caption, created_at, expires_at)
+                    VALUES (%s,%s,%s,%s,%s,%s)
+                    RETURNING id
+                    """,
+                    (username, url, kind, caption, now, now + 24 * 60 * 60),
+                )
+                story_id = int(cur.fetchone()["id"])
+            conn.commit()
+        return {"ok": True, "id": story_id, "media_url": url}
+
+    if wants_ndjson(request):
+        return ndjson_upload_response(size, finish)
+    # blocking Cloudinary upload + DB write run off the event loop
+    return await run_in_threadpool(finish)
 
 
 @app.delete("/api/stories/{story_id}")
@@ -1221,6 +2228,7 @@ def delete_story(story_id: int, username: str = Depends(get_current_username)):
 # =========================
 @app.post("/api/avatar")
 async def upload_avatar(
+    request: Request,
     file: UploadFile = File(...),
     username: str = Depends(get_current_username),
 ):
@@ -1228,36 +2236,43 @@ async def upload_avatar(
     if content_type not in ALLOWED_IMAGE_MIME and not content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="Avatar must be an image")
 
-    data = await file.read()
-    if len(data) > MAX_UPLOAD_BYTES:
+    size = upload_size(file)
+    if size > MAX_UPLOAD_BYTES:
         raise HTTPException(status_code=413, detail=f"File too large (max {MAX_UPLOAD_MB}MB)")
 
-    try:
-        up = cloudinary.uploader.upload(
-            data,
-            folder="messenger/avatars",
-            resource_type="image",
-            overwrite=False,
-            public_id=f"avatar_{username}_{now_ts()}",
-        )
-        url = up.get("secure_url") or up.get("url")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Cloudinary upload failed: {e}")
+    def finish() -> dict:
+        try:
+            up = cloudinary.uploader.upload(
+                file.file,
+                folder="messenger/avatars",
+                resource_type="image",
+                overwrite=False,
+                public_id=f"avatar_{username}_{now_ts()}",
+            )
+            url = up.get("secure_url") or up.get("url")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Cloudinary upload failed: {e}")
 
-    with db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT avatar_url FROM users WHERE username=%s", (username,))
-            prev = cur.fetchone()
-            prev_avatar = (prev["avatar_url"] if prev else None)
-            if prev_avatar:
-                cur.execute(
-                    "INSERT INTO user_avatar_history(username, avatar_url, created_at) VALUES(%s,%s,%s)",
-                    (username, prev_avatar, now_ts()),
-                )
-            cur.execute("UPDATE users SET avatar_url=%s WHERE username=%s", (url, username))
-        conn.commit()
+        with db() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT avatar_url FROM users WHERE username=%s", (username,))
+                prev = cur.fetchone()
+                prev_avatar = (prev["avatar_url"] if prev else None)
+                if prev_avatar:
+                    cur.execute(
+                        "INSERT INTO user_avatar_history(username, avatar_url, created_at) VALUES(%s,%s,%s)",
+                        (username, prev_avatar, now_ts()),
+                    )
+                cur.execute("UPDATE users SET avatar_url=%s WHERE username=%s", (url, username))
+            conn.commit()
+        AVATAR_CACHE.pop(username, None)
 
-    return {"ok": True, "avatar_url": url}
+        return {"ok": True, "avatar_url": url}
+
+    if wants_ndjson(request):
+        return ndjson_upload_response(size, finish)
+    # blocking Cloudinary upload + DB write run off the event loop
+    return await run_in_threadpool(finish)
 
 
 @app.get("/api/avatar/history")
@@ -1334,12 +2349,14 @@ def user_profile(target_username: str, username: str = Depends(get_current_usern
             )
             avatar_rows = cur.fetchall()
 
-    return {
-        "user": user_row,
-        "stories": story_rows,
-        "avatar_history": avatar_rows,
-        "can_manage": target_username == username,
-    }
+    return ORJSONResponse(
+        content={
+            "user": user_row,
+            "stories": story_rows,
+            "avatar_history": avatar_rows,
+            "can_manage": target_username == username,
+        }
+    )
 
 
 @app.get("/api/contacts")
@@ -1359,8 +2376,9 @@ def list_contacts(username: str = Depends(get_current_username)):
                 (username,),
             )
             rows = cur.fetchall()
+    online = frozenset(USER_SOCKETS)
     for row in rows:
-        row["online"] = row["username"] in USER_SOCKETS
+        row["online"] = row["username"] in online
     return {"contacts": rows}
 
 
@@ -1410,62 +2428,36 @@ def list_chats(username: str = Depends(get_current_username)):
     Returns chats with:
       id,type,title,created_by,created_at, unread
     """
+    version = CHATS_VERSION.get(username, 0)
+    cached = CHATS_CACHE.get(username)
+    if cached and cached[0] == version and (time.monotonic() - cached[1]) < CHATS_CACHE_TTL_SECONDS:
+        return {"chats": cached[2]}
+
     with db() as conn:
         with conn.cursor() as cur:
-            # unread = count of messages from others with id > last_read_id,
-            # excluding deleted_for_all, and excluding hidden-for-me.
+            # last_* and unread are maintained on chat_members at write time
+            # (bump_member_summaries / refresh_member_summaries).
             cur.execute(
                 """
-                WITH my_chats AS (
-                    SELECT c.id, c.type, c.title, c.created_by, c.created_at
-                    FROM chats c
-                    JOIN chat_members m ON m.chat_id = c.id
-                    WHERE m.username=%s
-                ),
-                reads AS (
-                    SELECT chat_id, last_read_id
-                    FROM chat_reads
-                    WHERE username=%s
-                ),
-                settings AS (
-                    SELECT chat_id, muted_until
-                    FROM chat_member_settings
-                    WHERE username=%s
-                )
                 SELECT
-                    mc.id, mc.type, mc.title, mc.created_by, mc.created_at,
-                    lm.sender AS last_sender,
-                    lm.text AS last_text,
-                    lm.created_at AS last_created_at,
-                    (SELECT s.muted_until FROM settings s WHERE s.chat_id = mc.id) AS muted_until,
-                    COALESCE((
-                        SELECT COUNT(*)
-                        FROM messages msg
-                        LEFT JOIN message_hidden hid
-                          ON hid.message_id = msg.id AND hid.username = %s
-                        WHERE msg.chat_id = mc.id
-                          AND msg.sender <> %s
-                          AND msg.deleted_for_all = FALSE
-                          AND hid.message_id IS NULL
-                          AND msg.id > COALESCE((SELECT r.last_read_id FROM reads r WHERE r.chat_id = mc.id), 0)
-                    ),0) AS unread
-                FROM my_chats mc
-                LEFT JOIN LATERAL (
-                    SELECT m.sender, m.text, m.created_at
-                    FROM messages m
-                    LEFT JOIN message_hidden h
-                      ON h.message_id = m.id AND h.username = %s
-                    WHERE m.chat_id = mc.id
-                      AND m.deleted_for_all = FALSE
-                      AND h.message_id IS NULL
-                    ORDER BY m.id DESC
-                    LIMIT 1
-                ) lm ON TRUE
-                ORDER BY mc.created_at DESC
+                    c.id, c.type, c.title, c.created_by, c.created_at,
+                    cm.last_sender,
+                    cm.last_text_preview AS last_text,
+                    cm.last_message_at AS last_created_at,
+                    s.muted_until,
+                    cm.unread_count AS unread
+                FROM chat_members cm
+                JOIN chats c ON c.id = cm.chat_id
+                LEFT JOIN chat_member_settings s
+                  ON s.chat_id = cm.chat_id AND s.username = cm.username
+                WHERE cm.username=%s
+                ORDER BY c.created_at DESC
                 """,
-                (username, username, username, username, username, username),
+                (username,),
             )
             rows = cur.fetchall()
+    if CHATS_CACHE_TTL_SECONDS > 0:
+        CHATS_CACHE[username] = (version, time.monotonic(), rows)
     return {"chats": rows}
 
 
@@ -1478,8 +2470,10 @@ def create_group_chat(data: ChatCreateIn, username: str = Depends(get_current_us
     chat_id = make_id("c_")
     now = now_ts()
 
+    # chat_id is freshly generated and member rows cascade away with their chat, so a new
+    # group cannot inherit stale members: three plain inserts, pipelined into one round-trip.
     with db() as conn:
-        with conn.cursor() as cur:
+        with conn.cursor() as cur, conn.pipeline():
             cur.execute(
                 "INSERT INTO chats(id, type, title, created_by, created_at) VALUES(%s,%s,%s,%s,%s)",
                 (chat_id, "group", title, username, now),
@@ -1492,9 +2486,6 @@ def create_group_chat(data: ChatCreateIn, username: str = Depends(get_current_us
                 """,
                 (chat_id, username, "owner", now),
             )
-            # Defensive cleanup: a new group must contain only creator.
-            cur.execute("DELETE FROM chat_members WHERE chat_id=%s AND username<>%s", (chat_id, username))
-            cur.execute("DELETE FROM chat_reads WHERE chat_id=%s AND username<>%s", (chat_id, username))
             cur.execute(
                 """
                 INSERT INTO chat_reads(chat_id, username, last_read_id, updated_at)
@@ -1505,15 +2496,22 @@ def create_group_chat(data: ChatCreateIn, username: str = Depends(get_current_us
             )
         conn.commit()
 
+    membership_add(chat_id, [username])
+    invalidate_chats_cache([username])
     return {"chat": {"id": chat_id, "title": title}}
 
 
-def _dm_key(a: str, b: str) -> Tuple[str, str, str]:
-    x, y = sorted([a, b])
+@functools.lru_cache(maxsize=8192)
+def _dm_pair(x: str, y: str) -> Tuple[str, str]:
     title = f"dm:{x}|{y}"
     # deterministic id so DM is unique
     h = hashlib.sha256(title.encode()).hexdigest()[:16]
-    chat_id = f"dm_{h}"
+    return f"dm_{h}", title
+
+
+def _dm_key(a: str, b: str) -> Tuple[str, str, str]:
+    x, y = (a, b) if a <= b else (b, a)
+    chat_id, title = _dm_pair(x, y)
     return chat_id, title, y if x == a else x
 
 
@@ -1525,46 +2523,49 @@ def create_dm_chat(data: DMCreateIn, username: str = Depends(get_current_usernam
     if other == username:
         raise HTTPException(status_code=400, detail="Нельзя создать DM с самим собой")
 
+    chat_id, title, other_name = _dm_key(username, other)
+    now = now_ts()
+
     with db() as conn:
         with conn.cursor() as cur:
             cur.execute("SELECT 1 FROM users WHERE username=%s", (other,))
             if cur.fetchone() is None:
                 raise HTTPException(status_code=404, detail="User not found")
 
-    chat_id, title, other_name = _dm_key(username, other)
-    now = now_ts()
-
-    with db() as conn:
-        with conn.cursor() as cur:
-            # create chat if not exists
-            cur.execute(
-                """
-                INSERT INTO chats(id, type, title, created_by, created_at)
-                VALUES (%s,'dm',%s,%s,%s)
-                ON CONFLICT (id) DO NOTHING
-                """,
-                (chat_id, title, username, now),
-            )
-            # add members
-            for u in {username, other}:
+            # Fire-and-forget writes: one pipelined round-trip instead of one per statement.
+            with conn.pipeline():
+                # create chat if not exists
+                cur.execute(
+                    """
+                    INSERT INTO chats(id, type, title, created_by, created_at)
+                    VALUES (%s,'dm',%s,%s,%s)
+                    ON CONFLICT (id) DO NOTHING
+                    """,
+                    (chat_id, title, username, now),
+                )
+                # add both members with one multi-row statement per table
                 cur.execute(
                     """
                     INSERT INTO chat_members(chat_id, username, role, joined_at)
-                    VALUES (%s,%s,%s,%s)
+                    VALUES (%s,%s,'admin',%s),(%s,%s,'admin',%s)
                     ON CONFLICT (chat_id, username) DO NOTHING
                     """,
-                    (chat_id, u, "admin", now),
+                    (chat_id, username, now, chat_id, other, now),
                 )
                 cur.execute(
                     """
                     INSERT INTO chat_reads(chat_id, username, last_read_id, updated_at)
-                    VALUES (%s,%s,0,%s)
+                    VALUES (%s,%s,0,%s),(%s,%s,0,%s)
                     ON CONFLICT (chat_id, username) DO NOTHING
                     """,
-                    (chat_id, u, now),
+                    (chat_id, username, now, chat_id, other, now),
                 )
+                # the DM may already hold history (e.g. one side left earlier)
+                refresh_member_summaries(cur, chat_id)
         conn.commit()
 
+    membership_add(chat_id, [username, other])
+    invalidate_chats_cache([username, other])
     return {"chat": {"id": chat_id, "title": f"DM: {other_name}"}}
 
 
@@ -1581,13 +2582,14 @@ async def invite_to_group(
         raise HTTPException(status_code=400, detail="Нельзя пригласить самого себя")
 
     with db() as conn:
-        chat = get_chat(conn, chat_id)
+        chat = load_chat_context(conn, chat_id, username)
         if not chat:
             raise HTTPException(status_code=404, detail="Chat not found")
         if chat["type"] != "group":
             raise HTTPException(status_code=400, detail="Invite only in group chats")
-        require_member(conn, chat_id, username)
-        if not can_moderate(conn, chat_id, username):
+        if chat["role"] is None:
+            raise HTTPException(status_code=403, detail="Not a member")
+        if not context_can_moderate(chat):
             raise HTTPException(status_code=403, detail="Only owner/admin can invite")
 
         with conn.cursor() as cur:
@@ -1612,8 +2614,10 @@ async def invite_to_group(
                 """,
                 (chat_id, other, now),
             )
+            refresh_member_summaries(cur, chat_id, other)
         conn.commit()
 
+    membership_add(chat_id, [other])
     # notify invited user (they will refresh chats)
     await broadcast_users([other], {"type": "invited", "chat_id": chat_id})
     return {"ok": True}
@@ -1631,11 +2635,12 @@ async def update_member_role(
         raise HTTPException(status_code=400, detail="role must be admin|member")
 
     with db() as conn:
-        chat = get_chat(conn, chat_id)
+        chat = load_chat_context(conn, chat_id, username)
         if not chat or chat["type"] != "group":
             raise HTTPException(status_code=404, detail="Group chat not found")
-        require_member(conn, chat_id, username)
-        if get_member_role(conn, chat_id, username) != "owner":
+        if chat["role"] is None:
+            raise HTTPException(status_code=403, detail="Not a member")
+        if chat["role"] != "owner":
             raise HTTPException(status_code=403, detail="Only owner can change roles")
         if target == chat["created_by"]:
             raise HTTPException(status_code=400, detail="Cannot change owner role")
@@ -1660,12 +2665,15 @@ async def remove_member(
     username: str = Depends(get_current_username),
 ):
     target = target.strip()
+    if not USERNAME_RE.match(target):
+        raise HTTPException(status_code=400, detail="Bad username")
     with db() as conn:
-        chat = get_chat(conn, chat_id)
+        chat = load_chat_context(conn, chat_id, username)
         if not chat or chat["type"] != "group":
             raise HTTPException(status_code=404, detail="Group chat not found")
-        require_member(conn, chat_id, username)
-        if not can_moderate(conn, chat_id, username):
+        if chat["role"] is None:
+            raise HTTPException(status_code=403, detail="Not a member")
+        if not context_can_moderate(chat):
             raise HTTPException(status_code=403, detail="Only owner/admin can remove members")
         if target == chat["created_by"]:
             raise HTTPException(status_code=400, detail="Owner cannot be removed")
@@ -1674,6 +2682,7 @@ async def remove_member(
             cur.execute("DELETE FROM chat_members WHERE chat_id=%s AND username=%s", (chat_id, target))
             cur.execute("DELETE FROM chat_reads WHERE chat_id=%s AND username=%s", (chat_id, target))
         conn.commit()
+    membership_discard(chat_id, [target])
 
     await broadcast_chat(chat_id, {"type": "member_removed", "chat_id": chat_id, "username": target})
     await broadcast_users([target], {"type": "chat_deleted", "chat_id": chat_id})
@@ -1701,6 +2710,7 @@ def mute_chat(
                 (chat_id, username, muted_until),
             )
         conn.commit()
+    invalidate_chats_cache([username])
     return {"ok": True, "muted_until": muted_until}
 
 
@@ -1732,11 +2742,10 @@ async def pin_message(
 ):
     message_id = int(data.message_id)
     with db() as conn:
-        require_member(conn, chat_id, username)
-        chat = get_chat(conn, chat_id)
-        if not chat:
-            raise HTTPException(status_code=404, detail="Chat not found")
-        if not can_moderate(conn, chat_id, username):
+        chat = load_chat_context(conn, chat_id, username)
+        if not chat or chat["role"] is None:
+            raise HTTPException(status_code=403, detail="Not a member")
+        if not context_can_moderate(chat):
             raise HTTPException(status_code=403, detail="Only owner/admin can pin")
         with conn.cursor() as cur:
             cur.execute("SELECT id FROM messages WHERE id=%s AND chat_id=%s", (message_id, chat_id))
@@ -1754,8 +2763,10 @@ async def pin_message(
 @app.delete("/api/chats/{chat_id}/pins/{message_id}")
 async def unpin_message(chat_id: str, message_id: int, username: str = Depends(get_current_username)):
     with db() as conn:
-        require_member(conn, chat_id, username)
-        if not can_moderate(conn, chat_id, username):
+        chat = load_chat_context(conn, chat_id, username)
+        if not chat or chat["role"] is None:
+            raise HTTPException(status_code=403, detail="Not a member")
+        if not context_can_moderate(chat):
             raise HTTPException(status_code=403, detail="Only owner/admin can unpin")
         with conn.cursor() as cur:
             cur.execute("DELETE FROM chat_pins WHERE chat_id=%s AND message_id=%s", (chat_id, message_id))
@@ -1767,47 +2778,45 @@ async def unpin_message(chat_id: str, message_id: int, username: str = Depends(g
 @app.delete("/api/chats/{chat_id}")
 async def delete_chat(chat_id: str, username: str = Depends(get_current_username)):
     with db() as conn:
-        chat = get_chat(conn, chat_id)
+        chat = load_chat_context(conn, chat_id, username)
         if not chat:
             raise HTTPException(status_code=404, detail="Chat not found")
-
-        require_member(conn, chat_id, username)
+        if chat["role"] is None:
+            raise HTTPException(status_code=403, detail="Not a member")
 
         with conn.cursor() as cur:
             if chat["type"] == "group":
                 if chat["created_by"] != username:
                     raise HTTPException(status_code=403, detail="Only creator can delete group")
-                # delete everything
-                cur.execute("DELETE FROM message_hidden WHERE message_id IN (SELECT id FROM messages WHERE chat_id=%s)", (chat_id,))
-                cur.execute("DELETE FROM message_delivered WHERE message_id IN (SELECT id FROM messages WHERE chat_id=%s)", (chat_id,))
-                cur.execute("DELETE FROM chat_reads WHERE chat_id=%s", (chat_id,))
-                cur.execute("DELETE FROM messages WHERE chat_id=%s", (chat_id,))
-                cur.execute("DELETE FROM chat_members WHERE chat_id=%s", (chat_id,))
+                # members are gone after the cascade below; capture them for the notification
+                cur.execute("SELECT username FROM chat_members WHERE chat_id=%s", (chat_id,))
+                members = [r["username"] for r in cur.fetchall()]
+                # FKs cascade to messages, members, reads, pins, settings and per-message rows
                 cur.execute("DELETE FROM chats WHERE id=%s", (chat_id,))
                 conn.commit()
+                membership_discard(chat_id, members)
 
-                await broadcast_chat(chat_id, {"type": "chat_deleted", "chat_id": chat_id})
+                await broadcast_users(members, {"type": "chat_deleted", "chat_id": chat_id})
                 return {"ok": True}
 
             # dm: remove membership for current user (soft-delete for user)
             cur.execute("DELETE FROM chat_members WHERE chat_id=%s AND username=%s", (chat_id, username))
             cur.execute("DELETE FROM chat_reads WHERE chat_id=%s AND username=%s", (chat_id, username))
-            conn.commit()
-
             # if no members left -> fully delete
-            with conn.cursor() as cur2:
-                cur2.execute("SELECT COUNT(*) AS n FROM chat_members WHERE chat_id=%s", (chat_id,))
-                n = int(cur2.fetchone()["n"])
-                if n == 0:
-                    cur2.execute("DELETE FROM message_hidden WHERE message_id IN (SELECT id FROM messages WHERE chat_id=%s)", (chat_id,))
-                    cur2.execute("DELETE FROM message_delivered WHERE message_id IN (SELECT id FROM messages WHERE chat_id=%s)", (chat_id,))
-                    cur2.execute("DELETE FROM chat_reads WHERE chat_id=%s", (chat_id,))
-                    cur2.execute("DELETE FROM messages WHERE chat_id=%s", (chat_id,))
-                    cur2.execute("DELETE FROM chats WHERE id=%s", (chat_id,))
-                    conn.commit()
-
-    # notify remaining member(s) to refresh
-    await broadcast_chat(chat_id, {"type": "chat_deleted", "chat_id": chat_id})
+            cur.execute(
+                "DELETE FROM chats WHERE id=%s AND NOT EXISTS (SELECT 1 FROM chat_members WHERE chat_id=%s)",
+                (chat_id, chat_id),
+            )
+        conn.commit()
+    membership_discard(chat_id, [username])
+    invalidate_chats_cache([username])
+
+    # notify remaining member(s) to refresh; the leaver is included (and named) so that other
+    # workers drop its cached membership even when nobody else is left in the chat
+    await broadcast_users(
+        list_members(chat_id) + [username],
+        {"type": "chat_deleted", "chat_id": chat_id, "username": username},
+    )
     return {"ok": True}
 
 
@@ -1818,24 +2827,33 @@ def chat_overview(
     username: str = Depends(get_current_username),
 ):
     query = (q or "").strip()
+    # Escape LIKE metacharacters and lower once here so the predicate matches the trigram index.
+    like_pattern = "%" + query.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    search_filter = "AND LOWER(m.text) LIKE %s" if query else ""
+    search_params = (chat_id, like_pattern) if query else (chat_id,)
     with db() as conn:
         require_member(conn, chat_id, username)
-        with conn.cursor() as cur:
-            cur.execute(
-                """
+        # Four independent reads: queue them in one pipeline, then fetch (1 RTT instead of 4).
+        with (
+            conn.pipeline(),
+            conn.cursor() as cur_messages,
+            conn.cursor() as cur_media,
+            conn.cursor() as cur_links,
+            conn.cursor() as cur_members,
+        ):
+            cur_messages.execute(
+                f"""
                 SELECT m.id, m.sender, m.text, m.created_at
                 FROM messages m
                 WHERE m.chat_id=%s
                   AND m.deleted_for_all=FALSE
-                  AND (%s='' OR LOWER(m.text) LIKE LOWER(%s))
+                  {search_filter}
                 ORDER BY m.id DESC
                 LIMIT 40
                 """,
-                (chat_id, query, f"%{query}%"),
+                search_params,
             )
-            found_messages = cur.fetchall()
-
-            cur.execute(
+            cur_media.execute(
                 """
                 SELECT id, media_kind, media_url, media_name, sender, created_at
                 FROM messages
@@ -1847,27 +2865,19 @@ def chat_overview(
                 """,
                 (chat_id,),
             )
-            media = cur.fetchall()
-            rewrite_media_links(media)
-
-            cur.execute(
+            cur_links.execute(
                 """
                 SELECT id, sender, text, created_at
                 FROM messages
                 WHERE chat_id=%s
+                  AND has_link
                   AND deleted_for_all=FALSE
-                  AND (
-                    text ~* '(https?://[^\\s]+)'
-                    OR text LIKE 'www.%'
-                  )
                 ORDER BY id DESC
                 LIMIT 80
                 """,
                 (chat_id,),
             )
-            links = cur.fetchall()
-
-            cur.execute(
+            cur_members.execute(
                 """
                 SELECT m.username,
                        m.role,
@@ -1880,10 +2890,16 @@ def chat_overview(
                 """,
                 (chat_id,),
             )
-            members = cur.fetchall()
-
+            found_messages = cur_messages.fetchall()
+            media = cur_media.fetchall()
+            links = cur_links.fetchall()
+            members = cur_members.fetchall()
+    rewrite_media_links(media)
+
+    # One consistent snapshot (built under the GIL) instead of probing the live dict per member.
+    online = frozenset(USER_SOCKETS)
     for m in members:
-        m["online"] = m["username"] in USER_SOCKETS
+        m["online"] = m["username"] in online
 
     return {
         "messages": found_messages,
@@ -1896,6 +2912,123 @@ def chat_overview(
 # =========================
 # WebSocket: global user channel
 # =========================
+async def _ws_handle_pong(data: dict, username: str, ws: WebSocket) -> None:
+    if ws in WS_LAST_PONG:
+        WS_LAST_PONG[ws] = time.monotonic()
+
+
+async def _ws_handle_typing(data: dict, username: str, ws: WebSocket) -> None:
+    chat_id = (data.get("chat_id") or "").strip()
+    is_typing = bool(data.get("is_typing"))
+    if not chat_id:
+        return
+    if not is_member_cached(chat_id, username):
+        return
+    await broadcast_chat(chat_id, {
+        "type": "typing",
+        "chat_id": chat_id,
+        "username": username,
+        "is_typing": is_typing,
+    })
+
+
+async def _ws_handle_delivered(data: dict, username: str, ws: WebSocket) -> None:
+    chat_id = (data.get("chat_id") or "").strip()
+    mid = int(data.get("message_id") or 0)
+    if not chat_id or not 0 < mid <= PG_BIGINT_MAX:
+        return
+    if not is_member_cached(chat_id, username):
+        return
+    # written in batches by delivered_flush_loop()
+    queue_delivered(chat_id, mid, username)
+
+    # rebroadcast so sender can update ✓✓
+    await broadcast_chat(chat_id, {
+        "type": "delivered",
+        "chat_id": chat_id,
+        "message_id": mid,
+        "username": username,
+    })
+
+
+async def _ws_handle_read(data: dict, username: str, ws: WebSocket) -> None:
+    chat_id = (data.get("chat_id") or "").strip()
+    last_id = int(data.get("last_id") or 0)
+    if not chat_id or last_id <= 0:
+        return
+    if not is_member_cached(chat_id, username):
+        return
+    # written and broadcast as "read" by reads_flush_loop()
+    queue_read(chat_id, username, last_id)
+
+
+async def _ws_handle_call(data: dict, username: str, ws: WebSocket) -> None:
+    t = data.get("type")
+    chat_id = (data.get("chat_id") or "").strip()
+    call_id = str(data.get("call_id") or "").strip()
+    mode = str(data.get("mode") or "voice").strip().lower()
+    if not chat_id or not call_id:
+        return
+    if not is_member_cached(chat_id, username):
+        return
+    members = [u for u in list_members(chat_id) if u != username]
+    recipients_online = connected_members(members)
+    recipients = recipients_online
+
+    event_type = "call_answer" if t == "call_accept" else t
+    if event_type == "call_offer":
+        event_type = "incoming_call"
+
+    if t == "call_offer":
+        LOGGER.info("call_start from=%s to=%s", username, ",".join(members) or "-")
+        LOGGER.info("callee online connections=%s", sum(active_connections_count(u) for u in members))
+
+    if t in {"call_answer", "call_accept", "call_reject", "call_ring_ack"}:
+        LOGGER.info("%s received from=%s call_id=%s", t, username, call_id)
+
+    if t == "call_offer" and not recipients:
+        await broadcast_users([username], {
+            "type": "call_timeout",
+            "chat_id": chat_id,
+            "call_id": call_id,
+            "mode": "video" if mode == "video" else "voice",
+            "username": username,
+            "started_at": int(data.get("started_at") or now_ts()),
+            "duration": 0,
+            "reason": "offline",
+        })
+        return
+
+    payload = {
+        "type": event_type,
+        "chat_id": chat_id,
+        "call_id": call_id,
+        "mode": "video" if mode == "video" else "voice",
+        "username": username,
+        "started_at": int(data.get("started_at") or now_ts()),
+        "duration": int(data.get("duration") or 0),
+        "reason": str(data.get("reason") or "").strip(),
+    }
+    target_sockets = [tws for target in recipients for tws in USER_SOCKETS.get(target, ())]
+    await asyncio.gather(*(ws_send_safe(tws, payload) for tws in target_sockets))
+    if t == "call_offer":
+        for target_ws in target_sockets:
+            LOGGER.info("sent incoming_call to callee connection id=%s", id(target_ws))
+
+
+# Client frame type -> handler(data, username, ws); unknown types are ignored.
+WS_HANDLERS: Dict[str, Callable[[dict, str, WebSocket], Awaitable[None]]] = {
+    "pong": _ws_handle_pong,
+    "typing": _ws_handle_typing,
+    "delivered": _ws_handle_delivered,
+    "read": _ws_handle_read,
+    **dict.fromkeys(
+        ("call_offer", "call_answer", "call_accept", "call_reject", "call_end", "call_timeout", "call_ring_ack"),
+        _ws_handle_call,
+    ),
+}
+
+
 @app.websocket("/ws/user")
 async def ws_user(ws: WebSocket):
     """
@@ -1912,6 +3045,8 @@ async def ws_user(ws: WebSocket):
     Sends:
       - typing {chat_id,is_typing}
       - delivered {chat_id,message_id}
+      - read {chat_id,last_id} (batched; POST /api/chats/{id}/read is the fallback)
+    With ?batch=1 broadcast bursts may arrive as {"type":"batch","events":[...]}.
     """
     token = (ws.query_params.get("token") or "").strip()
     if not token:
@@ -1931,6 +3066,9 @@ async def ws_user(ws: WebSocket):
 
     await ws.accept()
     _ws_add(username, ws)
+    if ws.query_params.get("batch") == "1":
+        WS_OUTBOX[ws] = []
+    hydrate_membership(username)
 
     if since_message_id > 0:
         for message in get_user_messages_since(username, since_message_id):
@@ -1938,137 +3076,20 @@ async def ws_user(ws: WebSocket):
             message["reactions"] = {}
             await ws_send_safe(ws, message)
 
-    last_pong_at = time.monotonic()
-    stop_heartbeat = asyncio.Event()
-
-    async def heartbeat_loop() -> None:
-        nonlocal last_pong_at
-        try:
-            while not stop_heartbeat.is_set():
-                await asyncio.sleep(WS_HEARTBEAT_INTERVAL_SECONDS)
-                if stop_heartbeat.is_set():
-                    break
-                if (time.monotonic() - last_pong_at) > WS_HEARTBEAT_TIMEOUT_SECONDS:
-                    await ws.close(code=1011, reason="heartbeat timeout")
-                    break
-                await ws_send_safe(ws, {"type": "ping", "ts": now_ts()})
-        except Exception:
-            pass
-
-    heartbeat_task = asyncio.create_task(heartbeat_loop())
-
     try:
         while True:
             raw = await ws.receive_text()
             try:
-                data = json.loads(raw)
+                data = orjson.loads(raw)
             except Exception:
                 continue
 
-            t = data.get("type")
-            if t == "pong":
-                last_pong_at = time.monotonic()
-                continue
-
-            if t == "typing":
-                chat_id = (data.get("chat_id") or "").strip()
-                is_typing = bool(data.get("is_typing"))
-                if not chat_id:
-                    continue
-                with db() as conn:
-                    if not is_member(conn, chat_id, username):
-                        continue
-                await broadcast_chat(chat_id, {
-                    "type": "typing",
-                    "chat_id": chat_id,
-                    "username": username,
-                    "is_typing": is_typing,
-                })
-
-            elif t == "delivered":
-                chat_id = (data.get("chat_id") or "").strip()
-                mid = int(data.get("message_id") or 0)
-                if not chat_id or not mid:
-                    continue
-                with db() as conn:
-                    if not is_member(conn, chat_id, username):
-                        continue
-                    with conn.cursor() as cur:
-                        cur.execute(
-                            """
-                            INSERT INTO message_delivered(message_id, username, delivered_at)
-                            VALUES (%s,%s,%s)
-                            ON CONFLICT (message_id, username) DO NOTHING
-                            """,
-                            (mid, username, now_ts()),
-                        )
-                    conn.commit()
-
-                # rebroadcast so sender can update ✓✓
-                await broadcast_chat(chat_id, {
-                    "type": "delivered",
-                    "chat_id": chat_id,
-                    "message_id": mid,
-                    "username": username,
-                })
-
-            elif t in {"call_offer", "call_answer", "call_accept", "call_reject", "call_end", "call_timeout", "call_ring_ack"}:
-                chat_id = (data.get("chat_id") or "").strip()
-                call_id = str(data.get("call_id") or "").strip()
-                mode = str(data.get("mode") or "voice").strip().lower()
-                if not chat_id or not call_id:
-                    continue
-                with db() as conn:
-                    if not is_member(conn, chat_id, username):
-                        continue
-                members = [u for u in list_members(chat_id) if u != username]
-                recipients_online = connected_members(members)
-                recipients = recipients_online
-
-                event_type = "call_answer" if t == "call_accept" else t
-                if event_type == "call_offer":
-                    event_type = "incoming_call"
-
-                if t == "call_offer":
-                    LOGGER.info("call_start from=%s to=%s", username, ",".join(members) or "-")
-                    LOGGER.info("callee online connections=%s", sum(active_connections_count(u) for u in members))
-
-                if t in {"call_answer", "call_accept", "call_reject", "call_ring_ack"}:
-                    LOGGER.info("%s received from=%s call_id=%s", t, username, call_id)
-
-                if t == "call_offer" and not recipients:
-                    await broadcast_users([username], {
-                        "type": "call_timeout",
-                        "chat_id": chat_id,
-                        "call_id": call_id,
-                        "mode": "video" if mode == "video" else "voice",
-                        "username": username,
-                        "started_at": int(data.get("started_at") or now_ts()),
-                        "duration": 0,
-                        "reason": "offline",
-                    })
-                    continue
-
-                payload = {
-                    "type": event_type,
-                    "chat_id": chat_id,
-                    "call_id": call_id,
-                    "mode": "video" if mode == "video" else "voice",
-                    "username": username,
-                    "started_at": int(data.get("started_at") or now_ts()),
-                    "duration": int(data.get("duration") or 0),
-                    "reason": str(data.get("reason") or "").strip(),
-                }
-                for target in recipients:
-                    for target_ws in list(USER_SOCKETS.get(target, set())):
-                        await ws_send_safe(target_ws, payload)
-                        if t == "call_offer":
-                            LOGGER.info("sent incoming_call to callee connection id=%s", id(target_ws))
+            handler = WS_HANDLERS.get(data.get("type"))
+            if handler is not None:
+                await handler(data, username, ws)
     except WebSocketDisconnect:
         pass
     finally:
-        stop_heartbeat.set()
-        heartbeat_task.cancel()
         _ws_remove(username, ws)
 
 
@@ -2080,6 +3101,7 @@ def list_messages(
     chat_id: str = Query(...),
     before_id: Optional[int] = Query(None),
     limit: int = Query(50),
+    cursor: Optional[str] = Query(None, max_length=64),
     username: str = Depends(get_current_username),
 ):
     chat_id = (chat_id or "").strip()
@@ -2087,6 +3109,9 @@ def list_messages(
         raise HTTPException(status_code=400, detail="chat_id required")
     before_raw = before_id if isinstance(before_id, (int, str)) else None
     before_message_id = int(before_raw) if before_raw not in (None, "") else None
+    # opaque next_cursor from a previous page; takes precedence over before_id
+    if isinstance(cursor, str) and cursor:
+        before_message_id = decode_messages_cursor(cursor)
     limit_raw = limit if isinstance(limit, int) else None
     page_limit = normalize_messages_limit(limit_raw)
 
@@ -2094,15 +3119,10 @@ def list_messages(
         require_member(conn, chat_id, username)
 
         with conn.cursor() as cur:
-            where_before = ""
-            params: List[Any] = [username, chat_id]
-            if before_message_id is not None:
-                where_before = " AND m.id < %s"
-                params.append(before_message_id)
-            params.append(page_limit + 1)
-
+            # One statement text for every page (before_id bound or NULL) so the server-side
+            # prepared plan is shared between the first page and older pages.
             cur.execute(
-                f"""
+                """
                 WITH picked AS (
                     SELECT
                       m.id, m.chat_id, m.sender, m.text, m.created_at,
@@ -2122,56 +3142,77 @@ def list_messages(
                       ON hid.message_id = m.id AND hid.username = %s
                     WHERE m.chat_id = %s
                       AND hid.message_id IS NULL
-                      {where_before}
+                      AND m.id < COALESCE(%s::bigint, 9223372036854775807)
                     ORDER BY m.id DESC
                     LIMIT %s
                 )
-                SELECT *
-                FROM picked
-                ORDER BY id ASC
+                SELECT p.*,
+                       COALESCE(rx.reactions, '{}'::jsonb) AS reactions,
+                       COALESCE(mr.my_reactions, ARRAY[]::text[]) AS my_reactions
+                FROM picked p
+                -- reactions are aggregated per page row only, in the same round-trip
+                LEFT JOIN LATERAL (
+                    SELECT jsonb_object_agg(emoji, cnt) AS reactions
+                    FROM (
+                        SELECT emoji, COUNT(*) AS cnt
+                        FROM message_reactions
+                        WHERE message_id = p.id
+                        GROUP BY emoji
+                    ) s
+                ) rx ON TRUE
+                LEFT JOIN LATERAL (
+                    SELECT array_agg(emoji) AS my_reactions
+                    FROM message_reactions
+                    WHERE message_id = p.id AND username = %s
+                ) mr ON TRUE
+                ORDER BY p.id ASC
                 """,
-                params,
+                (username, chat_id, before_message_id, page_limit, username),
             )
             rows = cur.fetchall()
 
-        has_more = len(rows) > page_limit
-        if has_more:
-            rows = rows[1:]
+    # a full page means there may be more; the next (possibly empty) page settles it
+    has_more = len(rows) == page_limit
 
-        with conn.cursor() as cur:
-            cur.execute(
-                "SELECT message_id, emoji, COUNT(*) AS cnt FROM message_reactions WHERE message_id = ANY(%s) GROUP BY message_id, emoji",
-                ([int(r["id"]) for r in rows] or [0],),
-            )
-            react_rows = cur.fetchall()
+    rewrite_media_links(rows)
+    next_cursor = encode_messages_cursor(rows[0]["id"]) if has_more else None
+    return {"messages": rows, "has_more": has_more, "next_cursor": next_cursor}
 
-            cur.execute(
-                "SELECT message_id, emoji FROM message_reactions WHERE message_id = ANY(%s) AND username=%s",
-                ([int(r["id"]) for r in rows] or [0], username),
-            )
-            mine_rows = cur.fetchall()
 
-    by_mid: Dict[int, Dict[str, int]] = {}
-    for rr in react_rows:
-        by_mid.setdefault(int(rr["message_id"]), {})[rr["emoji"]] = int(rr["cnt"])
+STATUS_CACHE_CONTROL = "private, max-age=2"
 
-    my_by_mid: Dict[int, List[str]] = {}
-    for rr in mine_rows:
-        my_by_mid.setdefault(int(rr["message_id"]), []).append(rr["emoji"])
 
-    for r in rows:
-        r["reactions"] = by_mid.get(int(r["id"]), {})
-        r["my_reactions"] = my_by_mid.get(int(r["id"]), [])
+def status_etag(*parts: Any) -> str:
+    digest = hashlib.blake2b(":".join(str(p) for p in parts).encode(), digest_size=8).hexdigest()
+    return f'"{digest}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match") or ""
+    candidates = {c.strip().removeprefix("W/") for c in header.split(",")}
+    return etag in candidates or "*" in candidates
 
-    rewrite_media_links(rows)
-    return {"messages": rows, "has_more": has_more}
+
+def status_response(request: Request, etag: str, body: dict) -> Any:
+    # polled endpoint: unchanged status answers 304 without serializing a body
+    headers = {"ETag": etag, "Cache-Control": STATUS_CACHE_CONTROL}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return ORJSONResponse(body, headers=headers)
 
 
 @app.get("/api/messages/{message_id}/status")
 def get_message_status(
+    request: Request,
     message_id: int,
+    members: bool = Query(True),
     username: str = Depends(get_current_username),
 ):
+    if members is False:
+        status = message_status_counts(message_id, username)
+        etag = status_etag("counts", status["delivered_count"], status["read_count"])
+        return status_response(request, etag, status)
+
     with db() as conn:
         with conn.cursor() as cur:
             cur.execute("SELECT chat_id, sender FROM messages WHERE id=%s", (message_id,))
@@ -2183,58 +3224,89 @@ def get_message_status(
 
             require_member(conn, chat_id, username)
 
+            # per-recipient rows plus the totals as window aggregates, in one statement
             cur.execute(
                 """
-                SELECT m.username,
-                       d.delivered_at,
-                       CASE WHEN r.last_read_id >= %s THEN r.updated_at ELSE NULL END AS read_at
-                FROM chat_members m
-                LEFT JOIN message_delivered d
-                  ON d.message_id=%s AND d.username=m.username
-                LEFT JOIN chat_reads r
-                  ON r.chat_id=%s AND r.username=m.username
-                WHERE m.chat_id=%s
-                ORDER BY m.joined_at ASC
+                SELECT s.username, s.delivered_at, s.read_at,
+                       COUNT(*) FILTER (WHERE s.delivered_at > 0) OVER () AS delivered_count,
+                       COUNT(*) FILTER (WHERE s.read_at > 0) OVER () AS read_count,
+                       MAX(s.delivered_at) FILTER (WHERE s.delivered_at > 0) OVER () AS delivered_latest,
+                       MAX(s.read_at) FILTER (WHERE s.read_at > 0) OVER () AS read_latest
+                FROM (
+                    SELECT m.username, m.joined_at,
+                           d.delivered_at,
+                           CASE WHEN r.last_read_id >= %s THEN r.updated_at ELSE NULL END AS read_at
+                    FROM chat_members m
+                    LEFT JOIN message_delivered d
+                      ON d.message_id=%s AND d.username=m.username
+                    LEFT JOIN chat_reads r
+                      ON r.chat_id=%s AND r.username=m.username
+                    WHERE m.chat_id=%s AND m.username <> %s
+                ) s
+                ORDER BY s.joined_at ASC
                 """,
-                (message_id, message_id, chat_id, chat_id),
+                (message_id, message_id, chat_id, chat_id, sender),
             )
             rows = cur.fetchall()
 
-    members = []
-    delivered_count = 0
-    read_count = 0
-    delivered_latest = 0
-    read_latest = 0
-
-    for r in rows:
-        u = r["username"]
-        if u == sender:
-            continue
-        delivered_at = int(r["delivered_at"] or 0)
-        read_at = int(r["read_at"] or 0)
-        if delivered_at > 0:
-            delivered_count += 1
-            delivered_latest = max(delivered_latest, delivered_at)
-        if read_at > 0:
-            read_count += 1
-            read_latest = max(read_latest, read_at)
-        members.append({
-            "username": u,
-            "delivered_at": (delivered_at or None),
-            "read_at": (read_at or None),
-        })
-
-    return {
+    totals = rows[0] if rows else {}
+    # every reader's own timestamps, not just the totals: swapping which member has read
+    # at the same count and second still changes the tag
+    etag = status_etag("members", *((r["username"], r["delivered_at"], r["read_at"]) for r in rows))
+    if etag_matches(request, etag):
+        return status_response(request, etag, {})
+
+    members = [
+        {
+            "username": r["username"],
+            "delivered_at": (r["delivered_at"] or None),
+            "read_at": (r["read_at"] or None),
+        }
+        for r in rows
+    ]
+
+    return status_response(request, etag, {
         "ok": True,
         "message_id": int(message_id),
         "chat_id": chat_id,
         "sender": sender,
         "members_total": len(members),
-        "delivered_count": delivered_count,
-        "read_count": read_count,
-        "delivered_latest": (delivered_latest or None),
-        "read_latest": (read_latest or None),
+        "delivered_count": int(totals.get("delivered_count") or 0),
+        "read_count": int(totals.get("read_count") or 0),
+        "delivered_latest": (totals.get("delivered_latest") or None),
+        "read_latest": (totals.get("read_latest") or None),
         "members": members,
+    })
+
+
+def message_status_counts(message_id: int, username: str) -> dict:
+    # ?members=false: counters only, from messages.delivered_count and an index range on chat_reads
+    with db() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT m.chat_id, m.sender, m.delivered_count,
+                       (
+                           SELECT COUNT(*) FROM chat_reads r
+                           WHERE r.chat_id = m.chat_id AND r.last_read_id >= m.id AND r.username <> m.sender
+                       ) AS read_count
+                FROM messages m
+                WHERE m.id=%s
+                """,
+                (message_id,),
+            )
+            msg = cur.fetchone()
+            if not msg:
+                raise HTTPException(status_code=404, detail="Message not found")
+            require_member(conn, msg["chat_id"], username)
+
+    return {
+        "ok": True,
+        "message_id": int(message_id),
+        "chat_id": msg["chat_id"],
+        "sender": msg["sender"],
+        "delivered_count": int(msg["delivered_count"]),
+        "read_count": int(msg["read_count"]),
     }
 
 
@@ -2243,7 +3315,7 @@ async def create_text_message(
     data: MessageCreateIn,
     username: str = Depends(get_current_username),
 ):
-    check_rate_limit(f"send:{username}", RATE_LIMIT_MAX_SEND)
+    await check_rate_limit_async(f"send:{username}", RATE_LIMIT_MAX_SEND)
     chat_id = (data.chat_id or "").strip()
     text = (data.text or "").strip()
     reply_to_id = int(data.reply_to_id or 0)
@@ -2258,43 +3330,66 @@ async def create_text_message(
     ts = now_ts()
 
     with db() as conn:
-        sender_avatar_url = None
         require_member(conn, chat_id, username)
 
         with conn.cursor() as cur:
-            cur.execute("SELECT avatar_url FROM users WHERE username=%s", (username,))
-            user_row = cur.fetchone()
-            sender_avatar_url = user_row["avatar_url"] if user_row else None
+            sender_avatar_url = get_avatar_url(cur, username)
 
-            reply_sender = None
-            reply_text = None
             if reply_to_id > 0:
-                cur.execute("SELECT id, sender, text, deleted_for_all FROM messages WHERE id=%s AND chat_id=%s", (reply_to_id, chat_id))
-                rep = cur.fetchone()
-                if not rep:
+                # the reply target is validated and quoted by the INSERT itself:
+                # no row comes back when it is missing or belongs to another chat
+                cur.execute(
+                    """
+                    WITH reply AS (
+                        SELECT id, sender,
+                               CASE
+                                 WHEN deleted_for_all THEN 'Это сообщение удалено'
+                                 ELSE LEFT(COALESCE(text, ''), 160)
+                               END AS text
+                        FROM messages
+                        WHERE id=%s AND chat_id=%s
+                    ), ins AS (
+                        INSERT INTO messages(chat_id, sender, text, created_at, reply_to_id)
+                        SELECT %s,%s,%s,%s, reply.id FROM reply
+                        RETURNING id, sender, created_at
+                    ), delivered AS (
+                        -- sender delivered to self (for completeness)
+                        INSERT INTO message_delivered(message_id, username, delivered_at)
+                        SELECT id, sender, created_at FROM ins
+                        ON CONFLICT DO NOTHING
+                    )
+                    SELECT ins.id, reply.sender AS reply_sender, reply.text AS reply_text
+                    FROM ins CROSS JOIN reply
+                    """,
+                    (reply_to_id, chat_id, chat_id, username, text, ts),
+                )
+                row = cur.fetchone()
+                if not row:
                     raise HTTPException(status_code=400, detail="reply_to message not found")
-                reply_sender = rep["sender"]
-                reply_text = "Это сообщение удалено" if rep["deleted_for_all"] else (rep["text"] or "")[:160]
-
-            cur.execute(
-                """
-                INSERT INTO messages(chat_id, sender, text, created_at, reply_to_id)
-                VALUES (%s,%s,%s,%s,%s)
-                RETURNING id
-                """,
-                (chat_id, username, text, ts, reply_to_id if reply_to_id > 0 else None),
-            )
-            msg_id = int(cur.fetchone()["id"])
-
-            # sender delivered to self (for completeness)
-            cur.execute(
-                """
-                INSERT INTO message_delivered(message_id, username, delivered_at)
-                VALUES (%s,%s,%s)
-                ON CONFLICT DO NOTHING
-                """,
-                (msg_id, username, ts),
-            )
+                reply_sender = row["reply_sender"]
+                reply_text = row["reply_text"]
+            else:
+                cur.execute(
+                    """
+                    WITH ins AS (
+                        INSERT INTO messages(chat_id, sender, text, created_at)
+                        VALUES (%s,%s,%s,%s)
+                        RETURNING id, sender, created_at
+                    ), delivered AS (
+                        -- sender delivered to self (for completeness)
+                        INSERT INTO message_delivered(message_id, username, delivered_at)
+                        SELECT id, sender, created_at FROM ins
+                        ON CONFLICT DO NOTHING
+                    )
+                    SELECT id FROM ins
+                    """,
+                    (chat_id, username, text, ts),
+                )
+                row = cur.fetchone()
+                reply_sender = None
+                reply_text = None
+            msg_id = int(row["id"])
+            bump_member_summaries(cur, chat_id, msg_id, ts, username, text)
 
         conn.commit()
 
@@ -2329,7 +3424,7 @@ async def forward_message(
     data: ForwardIn,
     username: str = Depends(get_current_username),
 ):
-    check_rate_limit(f"send:{username}", RATE_LIMIT_MAX_SEND)
+    await check_rate_limit_async(f"send:{username}", RATE_LIMIT_MAX_SEND)
     target_chat_id = (data.target_chat_id or "").strip()
     if not target_chat_id:
         raise HTTPException(status_code=400, detail="target_chat_id required")
@@ -2337,11 +3432,8 @@ async def forward_message(
     ts = now_ts()
 
     with db() as conn:
-        sender_avatar_url = None
         with conn.cursor() as cur:
-            cur.execute("SELECT avatar_url FROM users WHERE username=%s", (username,))
-            user_row = cur.fetchone()
-            sender_avatar_url = user_row["avatar_url"] if user_row else None
+            sender_avatar_url = get_avatar_url(cur, username)
 
             cur.execute(
                 """
@@ -2370,9 +3462,17 @@ async def forward_message(
 
             cur.execute(
                 """
-                INSERT INTO messages(chat_id, sender, text, created_at, media_kind, media_url, media_mime, media_name)
-                VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
-                RETURNING id
+                WITH ins AS (
+                    INSERT INTO messages(chat_id, sender, text, created_at, media_kind, media_url, media_mime, media_name)
+                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
+                    RETURNING id, sender, created_at
+                ), delivered AS (
+                    -- sender delivered to self (for completeness)
+                    INSERT INTO message_delivered(message_id, username, delivered_at)
+                    SELECT id, sender, created_at FROM ins
+                    ON CONFLICT DO NOTHING
+                )
+                SELECT id FROM ins
                 """,
                 (
                     target_chat_id,
@@ -2386,15 +3486,7 @@ async def forward_message(
                 ),
             )
             new_id = int(cur.fetchone()["id"])
-
-            cur.execute(
-                """
-                INSERT INTO message_delivered(message_id, username, delivered_at)
-                VALUES (%s,%s,%s)
-                ON CONFLICT DO NOTHING
-                """,
-                (new_id, username, ts),
-            )
+            bump_member_summaries(cur, target_chat_id, new_id, ts, username, body_text)
         conn.commit()
 
     payload = {
@@ -2434,29 +3526,34 @@ async def edit_message(
     if len(new_text) > 2000:
         raise HTTPException(status_code=400, detail="text too long (max 2000)")
 
+    edited_at = now_ts()
     with db() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT chat_id, sender, deleted_for_all, deleted_at FROM messages WHERE id=%s", (message_id,))
-            row = cur.fetchone()
-            if not row:
-                raise HTTPException(status_code=404, detail="Message not found")
-
-            chat_id = row["chat_id"]
-            require_member(conn, chat_id, username)
-            if row["sender"] != username:
-                raise HTTPException(status_code=403, detail="Only sender can edit")
-            if row["deleted_for_all"]:
-                raise HTTPException(status_code=400, detail="Message deleted")
-
-            edited_at = now_ts()
+            # permission checks live in the WHERE clause; the chat list preview follows in the same statement
             cur.execute(
                 """
-                UPDATE messages
-                SET text=%s, is_edited=TRUE, edited_at=%s
-                WHERE id=%s
+                WITH upd AS (
+                    UPDATE messages
+                    SET text=%s, is_edited=TRUE, edited_at=%s
+                    WHERE id=%s AND sender=%s AND deleted_for_all=FALSE
+                      AND EXISTS (
+                          SELECT 1 FROM chat_members cm
+                          WHERE cm.chat_id = messages.chat_id AND cm.username = %s
+                      )
+                    RETURNING chat_id
+                ), preview AS (
+                    UPDATE chat_members
+                    SET last_text_preview=LEFT(%s, %s)
+                    WHERE chat_id IN (SELECT chat_id FROM upd) AND last_message_id=%s
+                )
+                SELECT chat_id FROM upd
                 """,
-                (new_text, edited_at, message_id),
+                (new_text, edited_at, message_id, username, username, new_text, LAST_TEXT_PREVIEW_CHARS, message_id),
             )
+            row = cur.fetchone()
+            if not row:
+                raise message_write_denied(conn, message_id, username, "Only sender can edit", reject_deleted=True)
+            chat_id = row["chat_id"]
         conn.commit()
 
     await broadcast_chat(chat_id, {
@@ -2470,6 +3567,40 @@ async def edit_message(
     return {"ok": True}
 
 
+def message_write_denied(conn, message_id: int, username: str, sender_detail: str, *, reject_deleted: bool) -> HTTPException:
+    # error path of a guarded UPDATE that matched nothing: report why, in the usual check order
+    with conn.cursor() as cur:
+        cur.execute("SELECT chat_id, sender, deleted_for_all FROM messages WHERE id=%s", (message_id,))
+        row = cur.fetchone()
+    if not row:
+        return HTTPException(status_code=404, detail="Message not found")
+    require_member(conn, row["chat_id"], username)
+    if row["sender"] != username:
+        return HTTPException(status_code=403, detail=sender_detail)
+    if reject_deleted and row["deleted_for_all"]:
+        return HTTPException(status_code=400, detail="Message deleted")
+    return HTTPException(status_code=409, detail="Message changed, retry")
+
+
+def message_access_denied(conn, message_id: int, username: str) -> HTTPException:
+    # error path of a membership-guarded write that matched nothing: 404 or 403
+    with conn.cursor() as cur:
+        cur.execute("SELECT chat_id FROM messages WHERE id=%s", (message_id,))
+        row = cur.fetchone()
+    if not row:
+        return HTTPException(status_code=404, detail="Message not found")
+    require_member(conn, row["chat_id"], username)
+    return HTTPException(status_code=409, detail="Message changed, retry")
+
+
+# message row joined with the caller's membership; empty when either is missing
+_MESSAGE_TARGET_SQL = """
+SELECT m.chat_id FROM messages m
+JOIN chat_members cm ON cm.chat_id = m.chat_id AND cm.username = %s
+WHERE m.id = %s
+"""
+
+
 @app.delete("/api/messages/{message_id}")
 async def delete_message(
     message_id: int,
@@ -2482,35 +3613,47 @@ async def delete_message(
 
     with db() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT chat_id, sender FROM messages WHERE id=%s", (message_id,))
-            row = cur.fetchone()
-            if not row:
-                raise HTTPException(status_code=404, detail="Message not found")
-            chat_id = row["chat_id"]
-
-            require_member(conn, chat_id, username)
-
-            if scope == "me":
+            if scope == "all":
+                deleted_at = now_ts()
                 cur.execute(
                     """
-                    INSERT INTO message_hidden(message_id, username, hidden_at)
-                    VALUES (%s,%s,%s)
-                    ON CONFLICT DO NOTHING
+                    UPDATE messages SET deleted_for_all=TRUE, deleted_at=%s
+                    WHERE id=%s AND sender=%s
+                      AND EXISTS (
+                          SELECT 1 FROM chat_members cm
+                          WHERE cm.chat_id = messages.chat_id AND cm.username = %s
+                      )
+                    RETURNING chat_id
                     """,
-                    (message_id, username, now_ts()),
+                    (deleted_at, message_id, username, username),
                 )
+                row = cur.fetchone()
+                if not row:
+                    raise message_write_denied(
+                        conn, message_id, username, "Only sender can delete for all", reject_deleted=False
+                    )
+                chat_id = row["chat_id"]
+                refresh_member_summaries(cur, chat_id)
+            else:
+                cur.execute(
+                    f"""
+                    WITH target AS ({_MESSAGE_TARGET_SQL}), ins AS (
+                        INSERT INTO message_hidden(message_id, username, hidden_at)
+                        SELECT %s,%s,%s FROM target
+                        ON CONFLICT DO NOTHING
+                    )
+                    SELECT chat_id FROM target
+                    """,
+                    (username, message_id, message_id, username, now_ts()),
+                )
+                row = cur.fetchone()
+                if not row:
+                    raise message_access_denied(conn, message_id, username)
+                chat_id = row["chat_id"]
+                refresh_member_summaries(cur, chat_id, username)
                 conn.commit()
+                invalidate_chats_cache([username])
                 return {"ok": True}
-
-            # scope == all
-            if row["sender"] != username:
-                raise HTTPException(status_code=403, detail="Only sender can delete for all")
-
-            deleted_at = now_ts()
-            cur.execute(
-                "UPDATE messages SET deleted_for_all=TRUE, deleted_at=%s WHERE id=%s",
-                (deleted_at, message_id),
-            )
         conn.commit()
 
     await broadcast_chat(chat_id, {
@@ -2532,23 +3675,23 @@ async def add_reaction(
     if not emoji:
         raise HTTPException(status_code=400, detail="emoji required")
 
-    with db() as conn:
+    with db_autocommit() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT chat_id FROM messages WHERE id=%s", (message_id,))
-            row = cur.fetchone()
-            if not row:
-                raise HTTPException(status_code=404, detail="Message not found")
-            chat_id = row["chat_id"]
-            require_member(conn, chat_id, username)
             cur.execute(
-                """
-                INSERT INTO message_reactions(message_id, username, emoji, created_at)
-                VALUES (%s,%s,%s,%s)
-                ON CONFLICT DO NOTHING
+                f"""
+                WITH target AS ({_MESSAGE_TARGET_SQL}), ins AS (
+                    INSERT INTO message_reactions(message_id, username, emoji, created_at)
+                    SELECT %s,%s,%s,%s FROM target
+                    ON CONFLICT DO NOTHING
+                )
+                SELECT chat_id FROM target
                 """,
-                (message_id, username, emoji, now_ts()),
+                (username, message_id, message_id, username, emoji, now_ts()),
             )
-        conn.commit()
+            row = cur.fetchone()
+            if not row:
+                raise message_access_denied(conn, message_id, username)
+            chat_id = row["chat_id"]
 
     await broadcast_chat(chat_id, {"type": "reaction_added", "chat_id": chat_id, "message_id": message_id, "emoji": emoji, "username": username})
     return {"ok": True}
@@ -2561,16 +3704,24 @@ async def remove_reaction(
     username: str = Depends(get_current_username),
 ):
     emoji = (emoji or "").strip()[:16]
-    with db() as conn:
+    if not emoji:
+        raise HTTPException(status_code=400, detail="emoji required")
+    with db_autocommit() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT chat_id FROM messages WHERE id=%s", (message_id,))
+            cur.execute(
+                f"""
+                WITH target AS ({_MESSAGE_TARGET_SQL}), del AS (
+                    DELETE FROM message_reactions
+                    WHERE message_id=%s AND username=%s AND emoji=%s AND EXISTS (SELECT 1 FROM target)
+                )
+                SELECT chat_id FROM target
+                """,
+                (username, message_id, message_id, username, emoji),
+            )
             row = cur.fetchone()
             if not row:
-                raise HTTPException(status_code=404, detail="Message not found")
+                raise message_access_denied(conn, message_id, username)
             chat_id = row["chat_id"]
-            require_member(conn, chat_id, username)
-            cur.execute("DELETE FROM message_reactions WHERE message_id=%s AND username=%s AND emoji=%s", (message_id, username, emoji))
-        conn.commit()
 
     await broadcast_chat(chat_id, {"type": "reaction_removed", "chat_id": chat_id, "message_id": message_id, "emoji": emoji, "username": username})
     return {"ok": True}
@@ -2579,6 +3730,16 @@ async def remove_reaction(
 # =========================
 # Upload media (image/video/audio)
 # =========================
+def discard_cloudinary_upload(res: dict, kind: str) -> None:
+    public_id = res.get("public_id")
+    if not public_id:
+        return
+    try:
+        cloudinary.uploader.destroy(public_id, resource_type=cloudinary_resource_type(kind), invalidate=True)
+    except Exception:
+        LOGGER.warning("failed to discard rejected upload public_id=%s", public_id)
+
+
 @app.post("/api/upload")
 async def upload_media(
     chat_id: str = Form(...),
@@ -2586,7 +3747,7 @@ async def upload_media(
     file: UploadFile = File(...),
     username: str = Depends(get_current_username),
 ):
-    check_rate_limit(f"send:{username}", RATE_LIMIT_MAX_SEND)
+    await check_rate_limit_async(f"send:{username}", RATE_LIMIT_MAX_SEND)
     chat_id = (chat_id or "").strip()
     caption = (text or "").strip()
 
@@ -2601,17 +3762,20 @@ async def upload_media(
     if not kind:
         raise HTTPException(status_code=400, detail=f"Unsupported file type: {content_type}")
 
-    data = await file.read()
-    if len(data) > MAX_UPLOAD_BYTES:
+    # passed on as the spooled file object (disk-backed past 1MB), never read into bytes
+    if upload_size(file) > MAX_UPLOAD_BYTES:
         raise HTTPException(status_code=413, detail=f"File too large (max {MAX_UPLOAD_MB}MB)")
 
-    with db() as conn:
-        require_member(conn, chat_id, username)
+    # non-members never reach the paid upload (a cache hit costs no pool checkout);
+    # the INSERT's EXISTS below still covers a removal racing the upload
+    if not member_cache_hit(chat_id, username):
+        await run_in_threadpool(require_member_pooled, chat_id, username)
 
-    # upload to Cloudinary
     try:
-        res = cloudinary.uploader.upload(
-            data,
+        # blocking HTTPS upload: run it in the threadpool so the event loop keeps serving
+        res = await run_in_threadpool(
+            cloudinary.uploader.upload,
+            file.file,
             folder="messenger/uploads",
             resource_type=cloudinary_resource_type(kind),
             use_filename=True,
@@ -2625,32 +3789,36 @@ async def upload_media(
     media_name = (file.filename or "").strip()[:120]
 
     with db() as conn:
-        sender_avatar_url = None
         with conn.cursor() as cur:
-            cur.execute("SELECT avatar_url FROM users WHERE username=%s", (username,))
-            user_row = cur.fetchone()
-            sender_avatar_url = user_row["avatar_url"] if user_row else None
-
-            cur.execute(
-                """
-                INSERT INTO messages(chat_id, sender, text, created_at, media_kind, media_url, media_mime, media_name)
-                VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
-                RETURNING id
-                """,
-                (chat_id, username, caption, ts, kind, url, content_type, media_name),
-            )
-            msg_id = int(cur.fetchone()["id"])
+            sender_avatar_url = get_avatar_url(cur, username)
 
             cur.execute(
                 """
-                INSERT INTO message_delivered(message_id, username, delivered_at)
-                VALUES (%s,%s,%s)
-                ON CONFLICT DO NOTHING
+                WITH ins AS (
+                    INSERT INTO messages(chat_id, sender, text, created_at, media_kind, media_url, media_mime, media_name)
+                    SELECT %s,%s,%s,%s,%s,%s,%s,%s
+                    WHERE EXISTS (SELECT 1 FROM chat_members WHERE chat_id=%s AND username=%s)
+                    RETURNING id, sender, created_at
+                ), delivered AS (
+                    -- sender delivered to self (for completeness)
+                    INSERT INTO message_delivered(message_id, username, delivered_at)
+                    SELECT id, sender, created_at FROM ins
+                    ON CONFLICT DO NOTHING
+                )
+                SELECT id FROM ins
                 """,
-                (msg_id, username, ts),
+                (chat_id, username, caption, ts, kind, url, content_type, media_name, chat_id, username),
             )
+            row = cur.fetchone()
+            if row:
+                msg_id = int(row["id"])
+                bump_member_summaries(cur, chat_id, msg_id, ts, username, caption)
         conn.commit()
 
+    if not row:
+        await run_in_threadpool(discard_cloudinary_upload, res, kind)
+        raise HTTPException(status_code=403, detail="Not a member")
+
     payload = {
         "type": "message",
         "id": msg_id,
@@ -2684,6 +3852,12 @@ def access_media(token: str = Query(...)):
     if not chat_id or message_id <= 0:
         raise HTTPException(status_code=403, detail="Invalid media token")
 
+    cached = media_cache_get(message_id)
+    if cached is not None:
+        if cached[0] != chat_id:
+            raise HTTPException(status_code=403, detail="Invalid media token")
+        return Response(status_code=307, headers={"Location": cached[1]})
+
     with db() as conn:
         with conn.cursor() as cur:
             cur.execute(
@@ -2703,6 +3877,7 @@ def access_media(token: str = Query(...)):
     media_url = (row.get("media_url") or "").strip()
     if not media_url:
         raise HTTPException(status_code=404, detail="Media not found")
+    media_cache_put(message_id, row["chat_id"], media_url)
 
     return Response(status_code=307, headers={"Location": media_url})
 
@@ -2734,6 +3909,7 @@ async def mark_read(
                 """,
                 (chat_id, username, last_id, now_ts()),
             )
+            refresh_member_summaries(cur, chat_id, username)
         conn.commit()
 
     await broadcast_chat(chat_id, {
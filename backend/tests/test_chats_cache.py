@@ -0,0 +1,71 @@
+import asyncio
+
+
+def _install_chats_db(main, monkeypatch, calls):
+    class DummyCursor:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            return False
+
+        def execute(self, query, params=None):
+            calls.append(query)
+
+        def fetchall(self):
+            return [{"id": "c1", "title": "general", "unread": len(calls)}]
+
+    class DummyConn:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            return False
+
+        def cursor(self):
+            return DummyCursor()
+
+    monkeypatch.setattr(main, "db", lambda: DummyConn())
+
+
+def test_list_chats_served_from_cache_until_invalidated(main, monkeypatch):
+    calls = []
+    _install_chats_db(main, monkeypatch, calls)
+
+    first = main.list_chats(username="alice")
+    second = main.list_chats(username="alice")
+
+    assert len(calls) == 1
+    assert second == first
+
+    asyncio.run(main.broadcast_users(["alice"], {"type": "message", "chat_id": "c1"}))
+    third = main.list_chats(username="alice")
+
+    assert len(calls) == 2
+    assert third["chats"][0]["unread"] == 2
+
+
+def test_typing_broadcast_keeps_chats_cache(main, monkeypatch):
+    calls = []
+    _install_chats_db(main, monkeypatch, calls)
+
+    main.list_chats(username="alice")
+    asyncio.run(main.broadcast_users(["alice"], {"type": "typing", "chat_id": "c1"}))
+    main.list_chats(username="alice")
+
+    assert len(calls) == 1
+
+
+def test_chats_cache_is_off_for_several_workers_without_redis(monkeypatch, fresh_main_module):
+    monkeypatch.setenv("WEB_CONCURRENCY", "4")
+    monkeypatch.delenv("REDIS_URL", raising=False)
+    module = fresh_main_module()
+    calls = []
+    _install_chats_db(module, monkeypatch, calls)
+
+    module.list_chats(username="alice")
+    module.list_chats(username="alice")
+
+    assert module.CHATS_CACHE_TTL_SECONDS == 0
+    assert module.CHATS_CACHE == {}
+    assert len(calls) == 2
@@ -0,0 +1,165 @@
+import asyncio
+
+import pytest
+
+
+def test_delivered_receipts_flush_as_one_deduplicated_insert(main, monkeypatch):
+    executed = []
+
+    class DummyCursor:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            return False
+
+        def execute(self, query, params=None):
+            executed.append((query, params))
+
+    class DummyConn:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            return False
+
+        def cursor(self):
+            return DummyCursor()
+
+        def commit(self):
+            pass
+
+    monkeypatch.setattr(main, "db", lambda: DummyConn())
+
+    main.queue_delivered("c1", 10, "alice")
+    main.queue_delivered("c1", 10, "alice")
+    main.queue_delivered("c1", 11, "bob")
+
+    assert main.flush_delivered() == 2
+    assert len(executed) == 1
+    chats, ids, users, _ts = executed[0][1]
+    assert sorted(zip(chats, ids, users)) == [("c1", 10, "alice"), ("c1", 11, "bob")]
+
+    assert main.flush_delivered() == 0
+    assert len(executed) == 1
+
+
+
+def test_bad_delivered_receipt_does_not_drop_the_batch(main, monkeypatch):
+    messages = {10: "c1", 11: "c1"}
+    written = []
+
+    class DummyCursor:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            return False
+
+        def execute(self, query, params=None):
+            rows = list(zip(*params))
+            if "JOIN messages m ON m.id = t.message_id AND m.chat_id = t.chat_id" in query:
+                rows = [r for r in rows if messages.get(r[1]) == r[0]]
+            elif any(messages.get(r[1]) != r[0] for r in rows):
+                raise main.psycopg.errors.ForeignKeyViolation("message_delivered_message_id_fkey")
+            written.extend((mid, user) for _chat, mid, user, _ts in rows)
+
+    class DummyConn:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            return False
+
+        def cursor(self):
+            return DummyCursor()
+
+        def commit(self):
+            pass
+
+    monkeypatch.setattr(main, "db", lambda: DummyConn())
+
+    main.queue_delivered("c1", 10, "alice")
+    main.queue_delivered("c1", 999, "alice")  # made-up id
+    main.queue_delivered("c2", 11, "bob")  # real id, wrong chat
+    main.queue_delivered("c1", 11, "bob")
+    main.flush_delivered()
+
+    assert sorted(written) == [(10, "alice"), (11, "bob")]
+
+
+def test_delivered_receipt_outside_bigint_range_is_not_queued(main, monkeypatch):
+    monkeypatch.setattr(main, "is_member_cached", lambda chat_id, username: True)
+
+    asyncio.run(main._ws_handle_delivered({"chat_id": "c1", "message_id": 2**63}, "alice", ws=None))
+
+    assert main.DELIVERED_PENDING == {}
+
+def test_read_markers_keep_highest_id_per_chat_and_user(main, monkeypatch):
+    executed = []
+
+    class DummyCursor:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            return False
+
+        def execute(self, query, params=None):
+            executed.append((query, params))
+
+        def fetchall(self):
+            return [{"chat_id": "c1", "username": "alice"}, {"chat_id": "c1", "username": "bob"}]
+
+    class DummyConn:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            return False
+
+        def cursor(self):
+            return DummyCursor()
+
+        def pipeline(self):
+            return DummyCursor()
+
+        def commit(self):
+            pass
+
+    monkeypatch.setattr(main, "db", lambda: DummyConn())
+
+    main.queue_read("c1", "alice", 5)
+    main.queue_read("c1", "alice", 9)
+    main.queue_read("c1", "alice", 7)
+
+    items, members = main.flush_reads()
+    assert items == [("c1", "alice", 9)]
+    assert members == {"c1": ["alice", "bob"]}
+    upsert_params = executed[0][1]
+    assert upsert_params[1:] == (["c1"], ["alice"], [9])
+    # recipients for the whole batch come from one ANY() query
+    assert [p for q, p in executed if "ANY(%s)" in q] == [(["c1"],)]
+    assert main.flush_reads() == ([], {})
+
+
+def test_read_markers_are_requeued_when_flush_fails(main, monkeypatch):
+    class DummyConn:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            return False
+
+        def cursor(self):
+            raise main.psycopg.OperationalError("connection lost")
+
+    monkeypatch.setattr(main, "db", lambda: DummyConn())
+
+    main.queue_read("c1", "alice", 9)
+    with pytest.raises(main.psycopg.OperationalError):
+        main.flush_reads()
+
+    # requeued with max(): an older marker arriving afterwards does not regress it
+    main.queue_read("c1", "alice", 7)
+    assert main.PENDING_READS == {("c1", "alice"): 9}
@@ -0,0 +1,110 @@
+import asyncio
+
+
+def _install_members_db(main, monkeypatch, calls, rows):
+    class DummyCursor:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            return False
+
+        def execute(self, query, params=None):
+            calls.append(params)
+
+        def fetchone(self):
+            return {"?column?": 1} if rows else None
+
+        def fetchall(self):
+            return [{"chat_id": chat_id} for chat_id in rows]
+
+    class DummyConn:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            return False
+
+        def cursor(self):
+            return DummyCursor()
+
+    monkeypatch.setattr(main, "db", lambda: DummyConn())
+
+
+def test_membership_hit_skips_db_and_removal_falls_back(main, monkeypatch):
+    calls = []
+    rows = ["c1"]
+    _install_members_db(main, monkeypatch, calls, rows)
+
+    main.hydrate_membership("alice")
+    assert main.MEMBERSHIP["alice"] == {"c1"}
+
+    calls.clear()
+    assert main.is_member_cached("c1", "alice") is True
+    assert calls == []
+
+    main.membership_discard("c1", ["alice"])
+    rows.clear()
+    assert main.is_member_cached("c1", "alice") is False
+    assert calls == [("c1", "alice")]
+
+
+def test_member_cache_is_off_for_several_workers_without_redis(monkeypatch, fresh_main_module):
+    monkeypatch.setenv("WEB_CONCURRENCY", "4")
+    monkeypatch.delenv("REDIS_URL", raising=False)
+    module = fresh_main_module()
+    calls = []
+    monkeypatch.setattr(module, "is_member", lambda conn, chat_id, username: calls.append(chat_id) or True)
+
+    module.require_member(conn=object(), chat_id="c1", username="alice")
+    module.require_member(conn=object(), chat_id="c1", username="alice")
+
+    assert module.MEMBER_CACHE_TTL_SECONDS == 0
+    assert module.MEMBER_CACHE == {}
+    assert calls == ["c1", "c1"]
+
+
+def test_leaving_dm_names_the_leaver_so_other_workers_evict_it(main, monkeypatch):
+    class DummyCursor:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            return False
+
+        def execute(self, query, params=None):
+            pass
+
+    class DummyConn:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            return False
+
+        def cursor(self):
+            return DummyCursor()
+
+        def commit(self):
+            pass
+
+    sent = []
+
+    async def _broadcast_users(usernames, payload):
+        sent.append((usernames, payload))
+
+    monkeypatch.setattr(main, "db", lambda: DummyConn())
+    monkeypatch.setattr(main, "load_chat_context", lambda conn, chat_id, username: {"type": "dm", "role": "member"})
+    monkeypatch.setattr(main, "list_members", lambda chat_id: [])
+    monkeypatch.setattr(main, "broadcast_users", _broadcast_users)
+
+    asyncio.run(main.delete_chat("d1", username="alice"))
+
+    [(usernames, payload)] = sent
+    assert usernames == ["alice"]
+    assert payload == {"type": "chat_deleted", "chat_id": "d1", "username": "alice"}
+
+    # what the relay runs on another worker that still holds alice's cached membership
+    main.MEMBER_CACHE[("d1", "alice")] = float("inf")
+    asyncio.run(main._deliver_local([], payload))
+    assert ("d1", "alice") not in main.MEMBER_CACHE
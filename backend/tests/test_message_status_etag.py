@@ -0,0 +1,165 @@
+import pytest
+
+
+class DummyRequest:
+    def __init__(self, if_none_match=None):
+        self.headers = {"if-none-match": if_none_match} if if_none_match else {}
+
+
+def _stub_counts(main, monkeypatch, delivered=2, read=1):
+    def _counts(message_id, username):
+        return {
+            "ok": True,
+            "message_id": message_id,
+            "chat_id": "c1",
+            "sender": "alice",
+            "delivered_count": delivered,
+            "read_count": read,
+        }
+
+    monkeypatch.setattr(main, "message_status_counts", _counts)
+
+
+def test_status_sets_etag_and_cache_control(main, monkeypatch):
+    _stub_counts(main, monkeypatch)
+
+    resp = main.get_message_status(DummyRequest(), 7, members=False, username="bob")
+
+    assert resp.status_code == 200
+    assert resp.headers["etag"].startswith('"')
+    assert resp.headers["cache-control"] == "private, max-age=2"
+
+
+def test_status_returns_304_for_matching_etag(main, monkeypatch):
+    _stub_counts(main, monkeypatch)
+    etag = main.get_message_status(DummyRequest(), 7, members=False, username="bob").headers["etag"]
+
+    resp = main.get_message_status(DummyRequest(f"W/{etag}"), 7, members=False, username="bob")
+
+    assert resp.status_code == 304
+    assert resp.body == b""
+
+
+def test_status_etag_changes_with_counts(main, monkeypatch):
+    _stub_counts(main, monkeypatch, read=1)
+    etag = main.get_message_status(DummyRequest(), 7, members=False, username="bob").headers["etag"]
+
+    _stub_counts(main, monkeypatch, read=2)
+    resp = main.get_message_status(DummyRequest(etag), 7, members=False, username="bob")
+
+    assert resp.status_code == 200
+    assert resp.headers["etag"] != etag
+
+
+def _stub_member_rows(main, monkeypatch, rows):
+    class DummyCursor:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            return False
+
+        def execute(self, query, params=None):
+            pass
+
+        def fetchone(self):
+            return {"chat_id": "c1", "sender": "alice"}
+
+        def fetchall(self):
+            return rows
+
+    class DummyConn:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            return False
+
+        def cursor(self):
+            return DummyCursor()
+
+    monkeypatch.setattr(main, "db", lambda: DummyConn())
+    monkeypatch.setattr(main, "require_member", lambda conn, chat_id, username: None)
+
+
+def _member_row(username, read_at):
+    return {
+        "username": username,
+        "delivered_at": 100,
+        "read_at": read_at,
+        "delivered_count": 2,
+        "read_count": 1,
+        "delivered_latest": 100,
+        "read_latest": 200,
+    }
+
+
+def test_member_status_etag_changes_when_readers_swap(main, monkeypatch):
+    _stub_member_rows(main, monkeypatch, [_member_row("bob", 200), _member_row("carol", None)])
+    etag = main.get_message_status(DummyRequest(), 7, members=True, username="bob").headers["etag"]
+
+    # same counts and latest timestamps, different reader
+    _stub_member_rows(main, monkeypatch, [_member_row("bob", None), _member_row("carol", 200)])
+    resp = main.get_message_status(DummyRequest(etag), 7, members=True, username="bob")
+
+    assert resp.status_code == 200
+    assert resp.headers["etag"] != etag
+
+
+def _stub_counts_db(main, monkeypatch, row, queries):
+    class DummyCursor:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            return False
+
+        def execute(self, query, params=None):
+            queries.append((query, params))
+
+        def fetchone(self):
+            return row
+
+    class DummyConn:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            return False
+
+        def cursor(self):
+            return DummyCursor()
+
+    monkeypatch.setattr(main, "db", lambda: DummyConn())
+
+
+def test_status_counts_come_from_trigger_counter_and_read_range(main, monkeypatch):
+    queries, checked = [], []
+    row = {"chat_id": "c1", "sender": "alice", "delivered_count": 3, "read_count": 2}
+    _stub_counts_db(main, monkeypatch, row, queries)
+    monkeypatch.setattr(main, "require_member", lambda conn, chat_id, username: checked.append((chat_id, username)))
+
+    status = main.message_status_counts(7, "bob")
+
+    assert status == {
+        "ok": True,
+        "message_id": 7,
+        "chat_id": "c1",
+        "sender": "alice",
+        "delivered_count": 3,
+        "read_count": 2,
+    }
+    assert checked == [("c1", "bob")]
+    # one statement: the trigger-maintained column, no scan of message_delivered
+    [(query, params)] = queries
+    assert "m.delivered_count" in query and "message_delivered" not in query
+    assert params == (7,)
+
+
+def test_status_counts_unknown_message_is_404(main, monkeypatch):
+    _stub_counts_db(main, monkeypatch, None, [])
+
+    with pytest.raises(main.HTTPException) as err:
+        main.message_status_counts(7, "bob")
+
+    assert err.value.status_code == 404
@@ -0,0 +1,58 @@
+import pytest
+
+
+def _install_messages_db(main, monkeypatch, page, executed):
+    class DummyCursor:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            return False
+
+        def execute(self, query, params=None):
+            executed.append((query, params))
+
+        def fetchall(self):
+            return [{"id": mid, "chat_id": "c1", "media_url": None} for mid in page]
+
+    class DummyConn:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            return False
+
+        def cursor(self):
+            return DummyCursor()
+
+    monkeypatch.setattr(main, "db", lambda: DummyConn())
+    monkeypatch.setattr(main, "require_member", lambda conn, chat_id, username: None)
+
+
+def test_full_page_returns_cursor_for_next_page(main, monkeypatch):
+    executed = []
+    _install_messages_db(main, monkeypatch, [8, 9, 10], executed)
+
+    result = main.list_messages(chat_id="c1", limit=3, username="alice")
+
+    assert len(executed) == 1
+    assert executed[0][1][-3:-1] == (None, 3)
+    first_query = executed[0][0]
+    assert result["has_more"] is True
+    assert main.decode_messages_cursor(result["next_cursor"]) == 8
+
+    executed.clear()
+    _install_messages_db(main, monkeypatch, [7], executed)
+    result = main.list_messages(chat_id="c1", limit=3, cursor=result["next_cursor"], username="alice")
+
+    assert executed[0][1][-3:-1] == (8, 3)
+    assert executed[0][0] == first_query
+    assert result["has_more"] is False
+    assert result["next_cursor"] is None
+
+
+def test_bad_cursor_is_rejected(main):
+    with pytest.raises(main.HTTPException) as err:
+        main.decode_messages_cursor("not-a-cursor")
+
+    assert err.value.status_code == 400
@@ -0,0 +1,29 @@
+import asyncio
+import json
+
+
+class DummySocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send_text(self, text):
+        self.sent.append(json.loads(text))
+
+
+def test_batch_socket_gets_one_frame_per_burst_plain_socket_per_event(main):
+    batched, plain = DummySocket(), DummySocket()
+    main._ws_add("alice", batched)
+    main.WS_OUTBOX[batched] = []
+    main._ws_add("bob", plain)
+
+    async def burst():
+        for n in range(3):
+            await main.broadcast_users(["alice", "bob"], {"type": "typing", "n": n})
+        await asyncio.sleep(main.WS_BATCH_WINDOW_SECONDS * 3)
+
+    asyncio.run(burst())
+
+    assert [e["n"] for e in plain.sent] == [0, 1, 2]
+    assert len(batched.sent) == 1
+    assert batched.sent[0]["type"] == "batch"
+    assert [e["n"] for e in batched.sent[0]["events"]] == [0, 1, 2]
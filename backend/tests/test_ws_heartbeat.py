@@ -0,0 +1,28 @@
+import asyncio
+
+
+class DummySocket:
+    def __init__(self):
+        self.sent = []
+        self.closed = None
+
+    async def send_text(self, text):
+        self.sent.append(text)
+
+    async def close(self, code=1000, reason=""):
+        self.closed = code
+
+
+def test_heartbeat_tick_pings_live_and_closes_stale_sockets(main):
+    live, stale = DummySocket(), DummySocket()
+    main._ws_add("alice", live)
+    main._ws_add("bob", stale)
+    main.WS_LAST_PONG[stale] -= main.WS_HEARTBEAT_TIMEOUT_SECONDS + 1
+
+    asyncio.run(main.heartbeat_tick())
+
+    assert len(live.sent) == 1 and '"ping"' in live.sent[0]
+    assert live.closed is None
+    assert stale.sent == []
+    assert stale.closed == 1011
+    assert stale not in main.WS_LAST_PONG
@@ -1260,7 +1260,7 @@
 
     const proto = location.protocol === "https:" ? "wss:" : "ws:";
     const since = Math.max(lastMsgId, loadLastMessageId());
-    const url = `${proto}//${location.host}/ws/user?token=${encodeURIComponent(token)}&since=${encodeURIComponent(since)}`;
+    const url = `${proto}//${location.host}/ws/user?token=${encodeURIComponent(token)}&since=${encodeURIComponent(since)}&batch=1`;
 
     setNet("connecting…");
     ws = new WebSocket(url);
@@ -1275,7 +1275,12 @@
     ws.onmessage = (ev) => {
       let data = null;
       try{ data = JSON.parse(ev.data); }catch{ return; }
+      // batch=1: bursts may arrive coalesced as {"type":"batch","events":[...]}
+      const events = data && data.type === "batch" ? (data.events || []) : [data];
+      for (const item of events) handleWsEvent(item);
+    };
 
+    const handleWsEvent = (data) => {
       // invited -> refresh chats
       if (data.type === "invited"){
         refreshChats(true).catch(()=>{});
@@ -2514,6 +2519,13 @@
     if (lastMsgId <= lastMarked) return;
 
     lastMarked = lastMsgId;
+    // over an open socket the server batches read markers and answers with a "read" event
+    if (ws && ws.readyState === 1){
+      try{
+        ws.send(JSON.stringify({ type: "read", chat_id: activeChatId, last_id: lastMsgId }));
+        return;
+      }catch(_){}
+    }
     try{
       await api(`/api/chats/${encodeURIComponent(activeChatId)}/read?last_id=${lastMsgId}`, "POST");
       refreshChats(false).catch(()=>{});